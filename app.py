@@ -1,9 +1,15 @@
 from flask import Flask, redirect, url_for, send_from_directory
 from flask_login import LoginManager
-from config import db, SECRET_KEY, UPLOAD_DIR
+from werkzeug.middleware.proxy_fix import ProxyFix
+from config import db, SECRET_KEY, UPLOAD_DIR, MAX_UPLOAD_MB, TRUSTED_PROXY_COUNT
 from config_db import User
 from auth import bp_auth
 from view import bp_view
+from moderation import bp_moderation
+from metrics import bp_metrics
+from density import bp_density
+from recommend import bp_recommend
+from limiter import error_response
 
 login_manager = LoginManager()
 
@@ -11,10 +17,17 @@ login_manager = LoginManager()
 def create_app():
     # Flaskの起動
     app = Flask(__name__)
+    # リバースプロキシ越しでもrequest.remote_addrをクライアントのIPにする
+    if TRUSTED_PROXY_COUNT:
+        app.wsgi_app = ProxyFix(
+            app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=TRUSTED_PROXY_COUNT, x_host=TRUSTED_PROXY_COUNT
+        )
     # db接続
     db.connect()
     # Secret keyの設定
     app.config["SECRET_KEY"] = SECRET_KEY
+    # アップロードサイズの上限（超えたら413）
+    app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024
     # ログイン管理機能の準備
     login_manager.init_app(app)
 
@@ -31,10 +44,19 @@ def create_app():
     def uploaded_file(filename):
         return send_from_directory(UPLOAD_DIR, filename)
 
+    @app.errorhandler(413)
+    def request_entity_too_large(e):
+        # 登録画面のフォームからならフラッシュメッセージで画面に戻す
+        return error_response(f"ファイルサイズは{MAX_UPLOAD_MB}MBまでです", 413)
+
     # Blueprintの設定（ルーティングを分かりやすく）
     # api_bp = Blueprint("api", __name__, url_prefix="/api")
     app.register_blueprint(bp_auth)
     app.register_blueprint(bp_view)
+    app.register_blueprint(bp_moderation)
+    app.register_blueprint(bp_metrics)
+    app.register_blueprint(bp_density)
+    app.register_blueprint(bp_recommend)
     return app
 
 
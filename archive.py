@@ -0,0 +1,280 @@
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from peewee import chunked
+from config import db, ARCHIVE_DATABASE, ARCHIVE_RETENTION_DAYS
+from config_db import (
+    Spot,
+    SpotImage,
+    SpotTag,
+    SpotGood,
+    SpotBad,
+    SpotSolved,
+    Group,
+    GroupImage,
+    GroupSpot,
+    GroupTag,
+    GroupGood,
+    GroupBad,
+    Reply,
+    ReplyImage,
+    SpotRecommendation,
+)
+import bundle
+import density
+import recommend
+import tiles
+
+# 論理削除されてから一定期間たった行と、終了したイベントをアーカイブ用のSQLiteファイルへ移す
+# 毎回のクエリが歩くB-treeから不要な行を減らすため（削除済みの行もインデックスには残り続ける）
+# 少しずつトランザクションを分けて移すので、その間も書き込みは止まらない
+#   python archive.py                          アーカイブと incremental vacuum（1回あたりMAX_VACUUM_PAGESまで）
+#   python archive.py --dry-run                対象件数だけ表示
+#   python archive.py --enable-incremental-vacuum  既存DBを一度だけincremental vacuumに切り替える（VACUUMするので時間がかかる）
+
+# 1トランザクションで移す親の行数
+BATCH_SIZE = 200
+# バッチの間に空ける時間（他の書き込みにロックを譲る）
+PAUSE = 0.05
+# incremental vacuumで1トランザクションに解放するページ数と、1回の実行で解放するページ数の上限
+VACUUM_PAGES = 2000
+MAX_VACUUM_PAGES = 200000
+# アーカイブ側の検索用インデックス（CREATE TABLE ... AS SELECTではインデックスは作られない）
+# idは親子の結合、pathはreaper.pyが画像の参照を引くため
+ARCHIVE_INDEXES = {
+    "spots": "id",
+    "groups": "id",
+    "replies": "id",
+    "spot_images": "path",
+    "group_images": "path",
+    "reply_images": "path",
+}
+HOT_TABLES = ("spots", "replies", "groups", "spot_tags", "spot_images", "group_spots", "reply_images")
+
+
+# ---------------------------------------------------------------
+# アーカイブ先のテーブル準備
+# ---------------------------------------------------------------
+
+
+def attach():
+    if "archive" not in {row[1] for row in db.execute_sql("PRAGMA database_list").fetchall()}:
+        db.execute_sql("ATTACH DATABASE ? AS archive", (os.fspath(ARCHIVE_DATABASE),))
+
+
+def _columns(schema, table):
+    return [row[1] for row in db.execute_sql(f'PRAGMA {schema}.table_info("{table}")').fetchall()]
+
+
+def _prepare(models):
+    # アーカイブ側に同じカラムのテーブルを作る（後から本体にカラムが増えた場合も足す）
+    for model in models:
+        table = model._meta.table_name
+        db.execute_sql(f'CREATE TABLE IF NOT EXISTS archive."{table}" AS SELECT * FROM main."{table}" WHERE 0')
+        existing = set(_columns("archive", table))
+        for column in _columns("main", table):
+            if column not in existing:
+                db.execute_sql(f'ALTER TABLE archive."{table}" ADD COLUMN "{column}"')
+        if table in ARCHIVE_INDEXES:
+            column = ARCHIVE_INDEXES[table]
+            db.execute_sql(f'CREATE INDEX IF NOT EXISTS archive."{table}_{column}" ON "{table}" ("{column}")')
+
+
+def archived_image_owners(image_model, parent_model, names, deleted_before):
+    # アーカイブへ移した画像の ファイル名 → 所有ユーザーid（論理削除されていないか、削除から猶予期間内のもの）
+    # 終了したイベントは論理削除されずに移るので、その画像はreaper.pyに消させない
+    if not names or not os.path.exists(ARCHIVE_DATABASE):
+        return {}
+    attach()
+    images, parent = image_model._meta.table_name, parent_model._meta.table_name
+    tables = {row[0] for row in db.execute_sql("SELECT name FROM archive.sqlite_master WHERE type = 'table'")}
+    if images not in tables or parent not in tables:
+        return {}
+    fk = next(f.column_name for f in image_model._meta.refs if f.rel_model is parent_model)
+    placeholders = ", ".join("?" for _ in names)
+    cursor = db.execute_sql(
+        f'SELECT i."path", p."{parent_model.user.column_name}" FROM archive."{images}" AS i '
+        f'JOIN archive."{parent}" AS p ON p."id" = i."{fk}" '
+        f'WHERE i."path" IN ({placeholders}) AND (p."deleted_at" IS NULL OR p."deleted_at" >= ?)',
+        (*names, parent_model.deleted_at.db_value(deleted_before)),
+    )
+    return dict(cursor.fetchall())
+
+
+def _move(model, condition):
+    # 条件に合う行をアーカイブへコピーしてから本体から消す
+    table = model._meta.table_name
+    columns = ", ".join(f'"{c}"' for c in _columns("main", table))
+    ids_sql, params = model.select(model.id).where(condition).sql()
+    db.execute_sql(
+        f'INSERT INTO archive."{table}" ({columns}) SELECT {columns} FROM main."{table}" WHERE "id" IN ({ids_sql})',
+        params,
+    )
+    return model.delete().where(condition).execute()
+
+
+# ---------------------------------------------------------------
+# 親ごとの移動（子テーブルから順に）
+# ---------------------------------------------------------------
+
+
+def _move_replies(reply_ids):
+    _move(ReplyImage, ReplyImage.reply.in_(reply_ids))
+    return _move(Reply, Reply.id.in_(reply_ids))
+
+
+def _move_spots(spot_ids, effects):
+    # 後で消すキャッシュを控えておく（行が消えた後では場所も所属グループも分からない）
+    effects["points"] += list(Spot.select(Spot.lat, Spot.lng).where(Spot.id.in_(spot_ids)).tuples())
+    groups = GroupSpot.select(GroupSpot.group).where(GroupSpot.spot.in_(spot_ids)).tuples()
+    effects["groups"].update(g for (g,) in groups)
+    # 終了したイベントは論理削除されていないので密度グリッドから引く
+    density.remove_spots(spot_ids)
+
+    reply_ids = [r for (r,) in Reply.select(Reply.id).where(Reply.spot.in_(spot_ids)).tuples()]
+    if reply_ids:
+        _move_replies(reply_ids)
+    for model in (SpotImage, SpotTag, SpotGood, SpotBad, SpotSolved, GroupSpot):
+        _move(model, model.spot.in_(spot_ids))
+    # おすすめは計算結果なのでアーカイブせずに消す
+    SpotRecommendation.delete().where(SpotRecommendation.spot.in_(spot_ids)).execute()
+    return _move(Spot, Spot.id.in_(spot_ids))
+
+
+def _move_groups(group_ids, effects):
+    effects["removed_groups"].update(group_ids)
+    reply_ids = [r for (r,) in Reply.select(Reply.id).where(Reply.group.in_(group_ids)).tuples()]
+    if reply_ids:
+        _move_replies(reply_ids)
+    for model in (GroupImage, GroupSpot, GroupTag, GroupGood, GroupBad):
+        _move(model, model.group.in_(group_ids))
+    return _move(Group, Group.id.in_(group_ids))
+
+
+def _targets():
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(days=ARCHIVE_RETENTION_DAYS)
+    return [
+        ("spots", Spot, (Spot.deleted_at < cutoff) | (Spot.end_date < now), _move_spots),
+        ("groups", Group, Group.deleted_at < cutoff, _move_groups),
+        ("replies", Reply, Reply.deleted_at < cutoff, lambda ids, effects: _move_replies(ids)),
+    ]
+
+
+def _refresh_caches(effects):
+    for group_id in effects["removed_groups"]:
+        bundle.remove_group(group_id)
+    for group_id in effects["groups"] - effects["removed_groups"]:
+        bundle.invalidate_group(group_id)
+    tiles.invalidate_points(effects["points"])
+    recommend.mark_stale_around(effects["points"])
+
+
+def archive(dry_run=False):
+    moved = {}
+    attach()
+    _prepare(
+        [
+            Spot,
+            SpotImage,
+            SpotTag,
+            SpotGood,
+            SpotBad,
+            SpotSolved,
+            Group,
+            GroupImage,
+            GroupSpot,
+            GroupTag,
+            GroupGood,
+            GroupBad,
+            Reply,
+            ReplyImage,
+        ]
+    )
+    for name, model, condition, move in _targets():
+        ids = [i for (i,) in model.select(model.id).where(condition).order_by(model.id).tuples()]
+        moved[name] = len(ids)
+        if dry_run:
+            continue
+        for batch in chunked(ids, BATCH_SIZE):
+            effects = {"points": [], "groups": set(), "removed_groups": set()}
+            # 最初に書き込みロックを取る（読んでから書き込みに上げると、同時の書き込みとぶつかって即database is lockedになる）
+            with db.atomic("IMMEDIATE"):
+                move(batch, effects)
+            # コミットしたバッチ毎にキャッシュを更新（途中で止まっても移した分は地図やバンドルに残らない）
+            _refresh_caches(effects)
+            time.sleep(PAUSE)
+    return moved
+
+
+# ---------------------------------------------------------------
+# vacuumと計測
+# ---------------------------------------------------------------
+
+
+def _pragma(name):
+    return db.execute_sql(f"PRAGMA main.{name}").fetchone()[0]
+
+
+def incremental_vacuum(max_pages=MAX_VACUUM_PAGES):
+    # auto_vacuum=INCREMENTALでないDBでは何もしない（--enable-incremental-vacuumで切り替え）
+    # 戻り値: 解放したページ数（対象外のDBならNone）
+    if _pragma("auto_vacuum") != 2:
+        return None
+    freed = 0
+    while freed < max_pages:
+        pages = min(VACUUM_PAGES, max_pages - freed, _pragma("freelist_count"))
+        if pages <= 0:
+            break
+        # Pythonのsqlite3はPRAGMA incremental_vacuum(N)を1ステップしか実行しない（1ページしか解放されない）
+        # ので、1ページずつの実行をまとめて1トランザクションにする
+        with db.atomic("IMMEDIATE"):
+            for _ in range(pages):
+                db.execute_sql("PRAGMA main.incremental_vacuum(1)")
+        freed += pages
+        time.sleep(PAUSE)
+    return freed
+
+
+def enable_incremental_vacuum():
+    db.execute_sql("PRAGMA main.auto_vacuum = INCREMENTAL")
+    db.execute_sql("VACUUM")
+
+
+def _latency(runs=20):
+    # 地図表示と同じ形のクエリの所要時間（ミリ秒の中央値）
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        list(Spot.select().where(Spot.deleted_at.is_null()).order_by(Spot.date.desc()).limit(100))
+        Reply.select().where(Reply.deleted_at.is_null()).count()
+        timings.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(timings), 3)
+
+
+def measure():
+    return {
+        "rows": {table: db.execute_sql(f'SELECT COUNT(*) FROM main."{table}"').fetchone()[0] for table in HOT_TABLES},
+        "db_bytes": _pragma("page_count") * _pragma("page_size"),
+        "free_pages": _pragma("freelist_count"),
+        "query_ms": _latency(),
+    }
+
+
+def run(dry_run=False):
+    before = measure()
+    moved = archive(dry_run=dry_run)
+    vacuumed = None if dry_run else incremental_vacuum()
+    after = measure()
+    return {"moved": moved, "vacuumed": vacuumed, "before": before, "after": after}
+
+
+if __name__ == "__main__":
+    if "--enable-incremental-vacuum" in sys.argv:
+        enable_incremental_vacuum()
+    result = run(dry_run="--dry-run" in sys.argv)
+    print("moved:", result["moved"], "vacuumed:", result["vacuumed"])
+    for key in ("rows", "db_bytes", "free_pages", "query_ms"):
+        print(f"{key}: {result['before'][key]} -> {result['after'][key]}")
@@ -7,12 +7,15 @@ import os
 from datetime import datetime
 from config_db import User
 from config import UPLOAD_DIR
+from limiter import rate_limit, limit_uploads
 
 bp_auth = Blueprint("auth", __name__)
 # Blueprintでapiファイルを分けて管理
 
 
 @bp_auth.route("/register", methods=["GET", "POST"])
+@rate_limit("register")
+@limit_uploads
 def register():
 
     if request.method == "POST":
@@ -38,6 +41,7 @@ def register():
 
         # アイコン画像のアップロード処理
         icon_filename = None
+        temp_filename = None
         uploaded_file = request.files.get("icon")
         if uploaded_file and uploaded_file.filename:
             # 初回保存時は元ファイル名が使われるので、安全な名前に変更する
@@ -85,6 +89,9 @@ def register():
             return redirect(url_for("auth.login"))
 
         except IntegrityError:
+            # ユーザーが作れなかったので一時保存したアイコンも消す
+            if temp_filename and os.path.exists(os.path.join(icon_dir, temp_filename)):
+                os.remove(os.path.join(icon_dir, temp_filename))
             flash("登録に失敗しました")
             return redirect(request.url)
 
@@ -0,0 +1,277 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+from collections import defaultdict
+from contextlib import contextmanager
+from peewee import fn
+from config import BUNDLE_DIR
+from utils import write_atomic, read_text
+from config_db import (
+    User,
+    Spot,
+    SpotImage,
+    Tag,
+    SpotTag,
+    Reply,
+    Group,
+    GroupImage,
+    GroupSpot,
+    GroupTag,
+)
+
+# グループバンドル　QRコードで大量アクセスされるグループ表示を事前にJSON化しておく
+# 構成: BUNDLE_DIR/group_{id}/
+#   {version}.json           バンドル本体（内容のハッシュがversionなので不変）
+#   {version}.manifest.json  Service Worker用のプリキャッシュ一覧
+#   latest                   現在のversionと、生成を始めた時のstamp
+#   stamp                    無効化のたびに書き換わる乱数（latestのstampと違えば古い）
+#   lock                     再生成中のプロセスがflockするファイル
+# 読み込み時はlatestとstampを読むだけなのでDBには一切アクセスしない
+# 無効化されてもlatestは消さずに配信を続け、lockを取れた1リクエストだけが作り直す
+# （イベント中にリプライが付いても、同時に来たスキャンの数だけDBで生成することはない）
+
+# 古いQRコード/キャッシュからの参照用に直前のバージョンまでは残す
+KEEP_VERSIONS = 2
+
+
+def _group_dir(group_id):
+    return os.path.join(BUNDLE_DIR, f"group_{group_id}")
+
+
+def _read_stamp(group_dir):
+    return read_text(os.path.join(group_dir, "stamp")) or ""
+
+
+def _read_latest(group_dir):
+    # (version, 生成を始めた時のstamp)　まだ生成していなければ(None, None)
+    text = read_text(os.path.join(group_dir, "latest"))
+    if not text:
+        return None, None
+    version, _, stamp = text.strip().partition(" ")
+    return version, stamp
+
+
+@contextmanager
+def _rebuild_lock(group_dir, blocking):
+    # 同じグループを作り直すのは1つだけ　blocking=Falseで取れなければFalseを返す
+    os.makedirs(group_dir, exist_ok=True)
+    with open(os.path.join(group_dir, "lock"), "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _collect(group):
+    # spot毎にタグや画像を取りに行くとN+1になるので、id一覧でまとめて取得する
+    spots = list(
+        Spot.select(Spot, User)
+        .join(GroupSpot)
+        .switch(Spot)
+        .join(User)
+        .where(GroupSpot.group == group.id, Spot.deleted_at.is_null())
+        .order_by(Spot.date.desc())
+    )
+    spot_ids = [spot.id for spot in spots]
+
+    tags = defaultdict(list)
+    images = defaultdict(list)
+    reply_counts = {}
+    if spot_ids:
+        for row in (
+            SpotTag.select(SpotTag.spot, Tag.name)
+            .join(Tag)
+            .where(SpotTag.spot.in_(spot_ids))
+            .order_by(SpotTag.id)
+            .tuples()
+        ):
+            tags[row[0]].append(row[1])
+        for spot_id, path in (
+            SpotImage.select(SpotImage.spot, SpotImage.path)
+            .where(SpotImage.spot.in_(spot_ids))
+            .order_by(SpotImage.id)
+            .tuples()
+        ):
+            images[spot_id].append(path)
+        reply_counts = dict(
+            Reply.select(Reply.spot, fn.COUNT(Reply.id))
+            .where(Reply.spot.in_(spot_ids), Reply.deleted_at.is_null())
+            .group_by(Reply.spot)
+            .tuples()
+        )
+
+    group_tags = [tag.name for tag in Tag.select().join(GroupTag).where(GroupTag.group == group)]
+    group_images = [img.path for img in GroupImage.select().where(GroupImage.group == group).order_by(GroupImage.id)]
+    group_reply_count = Reply.select().where(Reply.group == group.id, Reply.deleted_at.is_null()).count()
+
+    return {
+        "group": {
+            "id": group.id,
+            "title": group.title,
+            "description": group.description,
+            "category": group.category,
+            "user_name": group.user.name,
+            "user_icon": group.user.icon,
+            "date": group.date.strftime("%Y-%m-%d %H:%M"),
+            "tags": group_tags,
+            "is_public": group.is_public,
+            "images": group_images,
+            "lat": group.lat,
+            "lon": group.lon,
+            "reply_count": group_reply_count,
+        },
+        "spots": [
+            {
+                "id": spot.id,
+                "title": spot.title,
+                "lat": float(spot.lat),
+                "lng": float(spot.lng),
+                "category": spot.category,
+                "user_name": spot.user.name,
+                "user_icon": spot.user.icon,
+                "date": spot.date.strftime("%Y-%m-%d %H:%M"),
+                "comment": spot.comment,
+                "tags": tags[spot.id],
+                "images": images[spot.id],
+                "reply_count": reply_counts.get(spot.id, 0),
+            }
+            for spot in spots
+        ],
+    }
+
+
+def _manifest(group_id, version, payload):
+    # Service Workerが会場到着前にまとめて取得しておくURL一覧
+    precache = [
+        f"/groups/{group_id}/view",
+        f"/groups/{group_id}/bundle/{version}.json",
+    ]
+    precache += [f"/uploads/group/{path}" for path in payload["group"]["images"]]
+    for spot in payload["spots"]:
+        # サムネイル用途なので各spotの1枚目のみ
+        if spot["images"]:
+            precache.append(f"/uploads/spot/{spot['images'][0]}")
+    return {"group_id": group_id, "version": version, "start_url": f"/groups/{group_id}/view", "precache": precache}
+
+
+def _cleanup(group_dir, keep):
+    versions = []
+    for entry in os.scandir(group_dir):
+        if entry.name.endswith(".json") and not entry.name.endswith(".manifest.json"):
+            versions.append((entry.stat().st_mtime_ns, entry.name[: -len(".json")]))
+    versions.sort(reverse=True)
+    for _, version in versions[KEEP_VERSIONS:]:
+        if version in keep:
+            continue
+        for name in (f"{version}.json", f"{version}.manifest.json"):
+            try:
+                os.remove(os.path.join(group_dir, name))
+            except FileNotFoundError:
+                pass
+
+
+def _build(group_id):
+    # _rebuild_lockを取った状態で呼ぶ　グループが存在しない（削除済み）ならNone
+    group = Group.select().where(Group.id == group_id, Group.deleted_at.is_null()).first()
+    if group is None:
+        return None
+
+    group_dir = _group_dir(group_id)
+    stamp = _read_stamp(group_dir)
+
+    payload = _collect(group)
+    body = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    # 内容のハッシュをversionにすることで同じ内容なら同じURLになる
+    version = hashlib.sha256(body.encode("utf-8")).hexdigest()[:16]
+    payload["version"] = version
+
+    bundle_path = os.path.join(group_dir, f"{version}.json")
+    if not os.path.exists(bundle_path):
+        write_atomic(bundle_path, json.dumps(payload, ensure_ascii=False))
+    manifest_path = os.path.join(group_dir, f"{version}.manifest.json")
+    if not os.path.exists(manifest_path):
+        write_atomic(manifest_path, json.dumps(_manifest(group_id, version, payload), ensure_ascii=False))
+
+    # 生成中に無効化された場合はstampが変わっているので、次のリクエストでもう一度作り直される
+    write_atomic(os.path.join(group_dir, "latest"), f"{version} {stamp}")
+    _cleanup(group_dir, keep={version})
+    return version
+
+
+def build_group_bundle(group_id):
+    with _rebuild_lock(_group_dir(group_id), blocking=True):
+        return _build(group_id)
+
+
+def latest_version(group_id):
+    # 最新ならlatestを読むだけ　古ければ1リクエストだけが作り直し、他は前のversionを返す
+    group_dir = _group_dir(group_id)
+    version, built_stamp = _read_latest(group_dir)
+    if version is None:
+        # 初回は返せるものがないので生成を待つ（存在しないidでフォルダを作らないよう先に確認）
+        if not Group.select().where(Group.id == group_id, Group.deleted_at.is_null()).exists():
+            return None
+        with _rebuild_lock(group_dir, blocking=True):
+            version, _ = _read_latest(group_dir)
+            return version or _build(group_id)
+
+    if built_stamp != _read_stamp(group_dir):
+        with _rebuild_lock(group_dir, blocking=False) as acquired:
+            if acquired:
+                # lockを待つ間に他が作り直していれば、それを返す
+                version, built_stamp = _read_latest(group_dir)
+                if built_stamp != _read_stamp(group_dir):
+                    return _build(group_id)
+    return version
+
+
+def bundle_path(group_id, version, manifest=False):
+    # versionはURLから来るので16進文字列以外は受け付けない
+    if not version or any(c not in "0123456789abcdef" for c in version):
+        return None
+    name = f"{version}.manifest.json" if manifest else f"{version}.json"
+    path = os.path.abspath(os.path.join(_group_dir(group_id), name))
+    return path if os.path.exists(path) else None
+
+
+def invalidate_group(group_id):
+    group_dir = _group_dir(group_id)
+    if not os.path.isdir(group_dir):
+        return
+    # stampを書き換えるだけ　latestは作り直されるまでそのまま配信する
+    write_atomic(os.path.join(group_dir, "stamp"), os.urandom(8).hex())
+
+
+def remove_group(group_id):
+    # 削除されたグループは古いversionのURLからも見えないようにファイルごと消す
+    shutil.rmtree(_group_dir(group_id), ignore_errors=True)
+
+
+def invalidate_groups_for_spots(spot_ids):
+    # spotを含む全グループのバンドルを無効化する
+    spot_ids = list(spot_ids)
+    if not spot_ids:
+        return
+    # 削除済みのspotやグループの紐付けも残っているので、生きているグループだけ
+    group_ids = (
+        GroupSpot.select(GroupSpot.group)
+        .join(Group)
+        .where(GroupSpot.spot.in_(spot_ids), Group.deleted_at.is_null())
+        .distinct()
+        .tuples()
+    )
+    for (group_id,) in group_ids:
+        invalidate_group(group_id)
+
+
+# 全グループのバンドルを事前生成する（デプロイ直後などに）
+if __name__ == "__main__":
+    for group in Group.select(Group.id).where(Group.deleted_at.is_null()):
+        print(group.id, build_group_bundle(group.id))
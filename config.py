@@ -16,3 +16,30 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 # 秘密鍵設定
 SECRET_KEY = os.getenv("SECRET_KEY")
+
+# グループバンドル（QRコード配布用の事前生成JSON）の保存先
+BUNDLE_DIR = Path(os.getenv("BUNDLE_DIR", "bundles"))
+os.makedirs(BUNDLE_DIR, exist_ok=True)
+
+# 管理者（違反報告・削除依頼を処理できるユーザー）のID　カンマ区切り
+ADMIN_USER_IDS = {int(x) for x in os.getenv("ADMIN_USER_IDS", "").split(",") if x.strip()}
+
+# レート制限の保存先　空ならプロセス内メモリ、"sqlite:パス"なら複数ワーカーで共有
+RATELIMIT_STORAGE = os.getenv("RATELIMIT_STORAGE", "")
+# アップロード1リクエストあたりの上限（MB）と、同時アップロード数の上限
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "10"))
+MAX_CONCURRENT_UPLOADS = int(os.getenv("MAX_CONCURRENT_UPLOADS", "8"))
+MAX_CONCURRENT_UPLOADS_PER_USER = int(os.getenv("MAX_CONCURRENT_UPLOADS_PER_USER", "2"))
+# 前段のリバースプロキシ（nginx等）の段数　0なら直接の接続元をクライアントのIPとする
+# 1以上ならX-Forwarded-For等をその段数分だけ信頼する（レート制限はクライアントのIP毎なので必ず合わせる）
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT", "0"))
+# /metricsの取得用トークン（Authorization: Bearer <token>）　空なら管理者のログインでのみ見られる
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# ベクタータイル（/tiles/{z}/{x}/{y}.mvt）のキャッシュ保存先
+TILE_DIR = Path(os.getenv("TILE_DIR", "tiles"))
+os.makedirs(TILE_DIR, exist_ok=True)
+
+# 論理削除から一定期間たった行・終了したイベントの移動先（別のSQLiteファイル）
+ARCHIVE_DATABASE = os.getenv("ARCHIVE_DATABASE", "spotter_archive.db")
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "90"))
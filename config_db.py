@@ -11,6 +11,7 @@ from peewee import (
     DoubleField,
     BooleanField,
 )
+from playhouse.migrate import SqliteMigrator, migrate
 
 
 # JWT標準がUTC基準なので関数化
@@ -23,7 +24,8 @@ class User(UserMixin, Model):
     name = CharField(max_length=128)
     email = CharField(max_length=254, unique=True)
     password_hash = CharField(max_length=255)
-    icon = CharField(max_length=512, null=True)
+    # reaper.pyがファイル名から参照元を引くのでインデックスを張る（画像のpathも同じ）
+    icon = CharField(max_length=512, null=True, index=True)
     date = TimestampField(default=_now)
     deleted_at = TimestampField(null=True)
 
@@ -48,11 +50,13 @@ class Spot(Model):
     class Meta:
         database = db
         table_name = "spots"
+        # タイル・周辺検索の範囲絞り込み用
+        indexes = ((("lat", "lng"), False),)
 
 
 class SpotImage(Model):
     spot = ForeignKeyField(Spot, backref="images", on_delete="CASCADE")
-    path = CharField(max_length=512)
+    path = CharField(max_length=512, index=True)
 
     class Meta:
         database = db
@@ -128,7 +132,7 @@ class Group(Model):
 
 class GroupImage(Model):
     group = ForeignKeyField(Group, backref="images", on_delete="CASCADE")  # 【修正】reply → group に変更
-    path = CharField(max_length=512)
+    path = CharField(max_length=512, index=True)
 
     class Meta:
         database = db
@@ -191,7 +195,7 @@ class Reply(Model):
 
 class ReplyImage(Model):
     reply = ForeignKeyField(Reply, backref="images", on_delete="CASCADE")
-    path = CharField(max_length=512)
+    path = CharField(max_length=512, index=True)
 
     class Meta:
         database = db
@@ -205,34 +209,118 @@ class Request(Model):
     comment = TextField(null=True)
     necessity = BooleanField(null=True)
     solved = BooleanField(default=False)
+    # 同じ対象への重複報告は1行にまとめて件数だけ増やす
+    report_count = IntegerField(default=1)
+    date = TimestampField(default=_now)
+    solved_at = TimestampField(null=True)
+    # 管理者の処理結果（"delete"か"dismiss"）　necessityは報告者の選んだ種別なので上書きしない
+    resolution = CharField(max_length=16, null=True)
 
     class Meta:
         database = db
         table_name = "requests"
+        # 重複報告の検索用と、未処理一覧のページング用
+        indexes = (
+            (("table", "target_id", "solved"), False),
+            (("solved", "id"), False),
+        )
+
+
+# spot密度の集計（観光地の分散化のための分析用）
+# ズーム毎のタイル座標をセルにして、カテゴリー・月毎に件数を持つ
+# category, bucketが空文字の行はその軸の合計（全カテゴリー・全期間）
+class DensityCell(Model):
+    zoom = IntegerField()
+    x = IntegerField()
+    y = IntegerField()
+    category = CharField(max_length=32)
+    bucket = CharField(max_length=7)  # "YYYY-MM"
+    spots = IntegerField(default=0)
+    replies = IntegerField(default=0)
+    goods = IntegerField(default=0)
+    bads = IntegerField(default=0)
+
+    class Meta:
+        database = db
+        table_name = "density_cells"
+        indexes = ((("zoom", "category", "bucket", "x", "y"), True),)
+
+
+# density.rebuildの作業用テーブル　ロックの外でここに作り直してから、短いトランザクションでdensity_cellsへ移す
+class DensityCellRebuild(DensityCell):
+    class Meta:
+        table_name = "density_cells_rebuild"
+
+
+# 「近くの空いている似たspot」の事前計算結果　spot毎に1行（JSONで候補一覧を持つ）
+# staleは周辺のspotやリアクションが変わって再計算が必要な印
+class SpotRecommendation(Model):
+    spot = ForeignKeyField(Spot, backref="recommendation", unique=True, on_delete="CASCADE")
+    alternatives = TextField(default="[]")
+    stale = BooleanField(default=True)
+    updated = TimestampField(null=True)
+
+    class Meta:
+        database = db
+        table_name = "spot_recommendations"
+        indexes = ((("stale",), False),)
+
+
+# アップロードファイルの使用量（ユーザー・種類毎）　reaper.pyが走査のたびに書き直す
+class StorageUsage(Model):
+    kind = CharField(max_length=16)
+    user = IntegerField()
+    files = IntegerField(default=0)
+    bytes = IntegerField(default=0)
+    updated = TimestampField(default=_now)
+
+    class Meta:
+        database = db
+        table_name = "storage_usage"
+        indexes = ((("user", "kind"), True),)
+
+
+# 既存DBに後から追加したカラムを足す（create_tablesは既存テーブルを変更しないため）
+def _add_missing_columns(models):
+    migrator = SqliteMigrator(db)
+    operations = []
+    for model in models:
+        table_name = model._meta.table_name
+        existing = {column.name for column in db.get_columns(table_name)}
+        for field in model._meta.sorted_fields:
+            if field.column_name not in existing:
+                operations.append(migrator.add_column(table_name, field.column_name, field))
+    if operations:
+        migrate(*operations)
 
 
 def create_tables():
-    db.create_tables(
-        [
-            User,
-            Spot,
-            SpotImage,
-            Tag,
-            SpotTag,
-            SpotGood,
-            SpotBad,
-            SpotSolved,
-            Group,
-            GroupImage,  # 【追加】GroupImageテーブルをテーブル作成リストに追加
-            GroupSpot,
-            GroupTag,
-            GroupGood,
-            GroupBad,
-            Reply,
-            ReplyImage,
-            Request,
-        ]
-    )
+    models = [
+        User,
+        Spot,
+        SpotImage,
+        Tag,
+        SpotTag,
+        SpotGood,
+        SpotBad,
+        SpotSolved,
+        Group,
+        GroupImage,  # 【追加】GroupImageテーブルをテーブル作成リストに追加
+        GroupSpot,
+        GroupTag,
+        GroupGood,
+        GroupBad,
+        Reply,
+        ReplyImage,
+        Request,
+        DensityCell,
+        SpotRecommendation,
+        StorageUsage,
+    ]
+    # 新規DBのみ有効（既存DBはarchive.pyの--enable-incremental-vacuumで一度だけ切り替える）
+    db.pragma("auto_vacuum", "incremental")
+    db.create_tables(models)
+    _add_missing_columns(models)
     db.pragma("foreign_keys", 1, permanent=True)
 
 
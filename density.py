@@ -0,0 +1,342 @@
+import os
+import sys
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ProcessPoolExecutor
+from flask import Blueprint, request, jsonify
+from peewee import chunked, fn
+from config import db
+from config_db import Spot, Reply, SpotGood, SpotBad, DensityCell, DensityCellRebuild
+import tiles
+
+# spot密度グリッド　「どこが混んでいて、どこが知られていないか」を全件スキャンせずに答えるための集計
+# spot・リプライの登録時に差分で更新し、ずれた時は python density.py rebuild で作り直す
+# （rebuildは動いているアプリの書き込みと並行してよいが、archive.pyとは同時に実行しない）
+# リアクション（goods/bads）は登録apiがまだないので、rebuildの時にだけ数える
+bp_density = Blueprint("density", __name__)
+
+# 集計するズーム（タイル座標をそのままセルにする）　z8: 約150km, z12: 約10km, z16: 約600m四方
+ZOOMS = (8, 12, 16)
+# 合計行のキー（全カテゴリー・全期間）
+ALL = ""
+COLUMNS = ("spots", "replies", "goods", "bads")
+BATCH_SIZE = 500
+
+
+def bucket_of(date):
+    return date.strftime("%Y-%m")
+
+
+def _cells(lat, lng, category, bucket):
+    # 1件の変化が反映されるセルのキー　ズーム毎に (カテゴリー, 期間) とそれぞれの合計
+    for zoom in ZOOMS:
+        fx, fy = tiles.lnglat_to_tile(float(lng), float(lat), zoom)
+        x, y = int(fx), int(fy)
+        for c in (category, ALL):
+            for b in (bucket, ALL):
+                yield (zoom, x, y, c, b)
+
+
+def _add(deltas, lat, lng, category, bucket, column, value=1):
+    for key in _cells(lat, lng, category, bucket):
+        deltas[key][column] += value
+
+
+def apply(deltas, model=DensityCell):
+    # deltas: {(zoom, x, y, category, bucket): Counter({"spots": 1, ...})}
+    # 行がなければ作り、あれば足し込む（UPSERT）　modelはrebuild中の作業用テーブルにも使う
+    rows = [(key, counts) for key, counts in deltas.items() if any(counts.values())]
+    if not rows:
+        return
+    with db.atomic():
+        for (zoom, x, y, category, bucket), counts in rows:
+            values = {column: counts[column] for column in COLUMNS}
+            model.insert(zoom=zoom, x=x, y=y, category=category, bucket=bucket, **values).on_conflict(
+                conflict_target=[
+                    model.zoom,
+                    model.category,
+                    model.bucket,
+                    model.x,
+                    model.y,
+                ],
+                update={
+                    getattr(model, column): getattr(model, column) + value
+                    for column, value in values.items()
+                    if value
+                },
+            ).execute()
+
+
+# ---------------------------------------------------------------
+# 書き込み時の差分更新
+# ---------------------------------------------------------------
+
+
+def record_spot(spot):
+    deltas = defaultdict(Counter)
+    _add(deltas, spot.lat, spot.lng, spot.category, bucket_of(spot.date), "spots")
+    apply(deltas)
+
+
+def record_reply(spot, reply):
+    deltas = defaultdict(Counter)
+    _add(deltas, spot.lat, spot.lng, spot.category, bucket_of(reply.date), "replies")
+    apply(deltas)
+
+
+def _live(model, marks):
+    # marksを渡すとrebuild開始時点で生きていたもの（それ以降に削除されたものを含む）
+    if marks is None:
+        return model.deleted_at.is_null()
+    return model.deleted_at.is_null() | (model.deleted_at >= marks["since"])
+
+
+def _spot_deltas(lo, hi, sign=1, spot_ids=None, marks=None):
+    # id範囲（またはid一覧）のspotについて、spot・リプライ・リアクションの件数を集計する
+    # marks: rebuild開始時点の最大idと日時　渡すとその時点の件数を数える
+    deltas = defaultdict(Counter)
+    query = Spot.select(Spot.id, Spot.lat, Spot.lng, Spot.category, Spot.date).where(_live(Spot, marks))
+    if spot_ids is not None:
+        query = query.where(Spot.id.in_(spot_ids))
+    else:
+        query = query.where(Spot.id >= lo, Spot.id < hi)
+    if marks is not None:
+        query = query.where(Spot.id <= marks["spots"])
+    spots = {spot_id: (lat, lng, category, date) for spot_id, lat, lng, category, date in query.tuples()}
+    if not spots:
+        return deltas
+
+    for lat, lng, category, date in spots.values():
+        _add(deltas, lat, lng, category, bucket_of(date), "spots", sign)
+
+    ids = list(spots)
+    for batch in chunked(ids, BATCH_SIZE):
+        replies = Reply.select(Reply.spot, Reply.date).where(Reply.spot.in_(batch), _live(Reply, marks))
+        if marks is not None:
+            replies = replies.where(Reply.id <= marks["replies"])
+        for spot_id, date in replies.tuples():
+            lat, lng, category, _ = spots[spot_id]
+            _add(deltas, lat, lng, category, bucket_of(date), "replies", sign)
+        for model, column in ((SpotGood, "goods"), (SpotBad, "bads")):
+            reactions = model.select(model.spot, fn.COUNT(model.id)).where(model.spot.in_(batch))
+            if marks is not None:
+                reactions = reactions.where(model.id <= marks[column])
+            for spot_id, count in reactions.group_by(model.spot).tuples():
+                lat, lng, category, date = spots[spot_id]
+                _add(deltas, lat, lng, category, bucket_of(date), column, sign * count)
+    return deltas
+
+
+def remove_spots(spot_ids):
+    # 論理削除する前に呼ぶ（削除済みは集計対象外なので、今の件数を引いておく）
+    deltas = defaultdict(Counter)
+    for batch in chunked(spot_ids, BATCH_SIZE):
+        for key, counts in _spot_deltas(None, None, sign=-1, spot_ids=batch).items():
+            deltas[key].update(counts)
+    apply(deltas)
+
+
+def remove_replies(reply_ids):
+    # 論理削除する前に呼ぶ
+    deltas = defaultdict(Counter)
+    for batch in chunked(reply_ids, BATCH_SIZE):
+        query = (
+            Reply.select(Reply.date, Spot.lat, Spot.lng, Spot.category)
+            .join(Spot)
+            .where(Reply.id.in_(batch), Reply.deleted_at.is_null(), Spot.deleted_at.is_null())
+            .tuples()
+        )
+        for date, lat, lng, category in query:
+            _add(deltas, lat, lng, category, bucket_of(date), "replies", -1)
+    apply(deltas)
+
+
+# ---------------------------------------------------------------
+# 全件の作り直し（プロセスプールで並列集計）
+# ---------------------------------------------------------------
+
+
+def _marks():
+    # rebuild開始時点の目印　各テーブルの最大idと日時を1つの読み込みトランザクションで取る
+    # 日時は削除日時の秒単位の丸めを考えて少し前にずらす（前にずれても_replayで差し引くので結果は同じ）
+    with db.atomic():
+        marks = {"since": datetime.now(timezone.utc) - timedelta(seconds=2)}
+        for column, model in (("spots", Spot), ("replies", Reply), ("goods", SpotGood), ("bads", SpotBad)):
+            marks[column] = model.select(fn.MAX(model.id)).scalar() or 0
+    return marks
+
+
+def _rebuild_worker(args):
+    # 子プロセスは自分で接続を開く
+    lo, hi, marks = args
+    db.connect(reuse_if_open=True)
+    try:
+        return dict(_spot_deltas(lo, hi, marks=marks))
+    finally:
+        db.close()
+
+
+def _replay(marks):
+    # ワーカーはmarksの時点の件数を数えているので、それ以降の書き込みを足し引きする
+    # 集計中にアプリが書き込んだ差分は作り直す前のグリッドに入っていて、入れ替えで消えるため
+    deltas = defaultdict(Counter)
+    since = marks["since"]
+
+    # 開始後に削除されたspot（リプライ・リアクションごと引く）
+    deleted = Spot.select(Spot.id).where(Spot.id <= marks["spots"], Spot.deleted_at >= since).tuples()
+    for batch in chunked([spot_id for (spot_id,) in deleted], BATCH_SIZE):
+        for key, counts in _spot_deltas(None, None, sign=-1, spot_ids=batch, marks=marks).items():
+            deltas[key].update(counts)
+
+    # 開始後に削除されたリプライ（spotごと削除されたものは上で引いている）
+    query = (
+        Reply.select(Reply.date, Spot.lat, Spot.lng, Spot.category)
+        .join(Spot)
+        .where(Reply.id <= marks["replies"], Reply.deleted_at >= since, Spot.deleted_at.is_null())
+    )
+    for date, lat, lng, category in query.tuples():
+        _add(deltas, lat, lng, category, bucket_of(date), "replies", -1)
+
+    # 開始後に増えたspot・リプライ・リアクション（今も生きているもの）
+    query = Spot.select(Spot.lat, Spot.lng, Spot.category, Spot.date).where(
+        Spot.id > marks["spots"], Spot.deleted_at.is_null()
+    )
+    for lat, lng, category, date in query.tuples():
+        _add(deltas, lat, lng, category, bucket_of(date), "spots")
+    query = (
+        Reply.select(Reply.date, Spot.lat, Spot.lng, Spot.category)
+        .join(Spot)
+        .where(Reply.id > marks["replies"], Reply.deleted_at.is_null(), Spot.deleted_at.is_null())
+    )
+    for date, lat, lng, category in query.tuples():
+        _add(deltas, lat, lng, category, bucket_of(date), "replies")
+    for model, column in ((SpotGood, "goods"), (SpotBad, "bads")):
+        query = (
+            model.select(Spot.lat, Spot.lng, Spot.category, Spot.date)
+            .join(Spot)
+            .where(model.id > marks[column], Spot.deleted_at.is_null())
+        )
+        for lat, lng, category, date in query.tuples():
+            _add(deltas, lat, lng, category, bucket_of(date), column)
+    return deltas
+
+
+def rebuild(workers=None, chunk=5000):
+    marks = _marks()
+    lo = Spot.select(fn.MIN(Spot.id)).scalar()
+    hi = marks["spots"]
+    ranges = [(start, start + chunk, marks) for start in range(lo, hi + 1, chunk)] if lo is not None else []
+
+    # fork前に親の接続を閉じる（SQLiteの接続を子プロセスと共有しない）
+    db.close()
+    deltas = defaultdict(Counter)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for partial in pool.map(_rebuild_worker, ranges):
+            for key, counts in partial.items():
+                deltas[key].update(counts)
+
+    # 作業用テーブルへの書き込みはロックの外で（セル数だけ行があるので時間がかかる）
+    db.connect(reuse_if_open=True)
+    DensityCellRebuild.drop_table(safe=True)
+    DensityCellRebuild.create_table()
+    rows = [
+        dict(zoom=zoom, x=x, y=y, category=category, bucket=bucket, **{column: counts[column] for column in COLUMNS})
+        for (zoom, x, y, category, bucket), counts in deltas.items()
+        if any(counts.values())
+    ]
+    for block in chunked(rows, 2000):
+        with db.atomic():
+            for batch in chunked(block, 50):
+                DensityCellRebuild.insert_many(batch).execute()
+
+    # 入れ替えの間だけアプリの書き込みを待たせる（view.pyはspot・リプライの登録とグリッドの更新を1トランザクションで行う）
+    # 集計後の差分を作業用テーブルに足してから、1文でdensity_cellsへ移す
+    fields = [DensityCell.zoom, DensityCell.x, DensityCell.y, DensityCell.category, DensityCell.bucket]
+    fields += [getattr(DensityCell, column) for column in COLUMNS]
+    with db.atomic("IMMEDIATE"):
+        apply(_replay(marks), model=DensityCellRebuild)
+        DensityCell.delete().execute()
+        source = DensityCellRebuild.select(*[getattr(DensityCellRebuild, f.name) for f in fields])
+        DensityCell.insert_from(source, fields).execute()
+    DensityCellRebuild.drop_table(safe=True)
+    return len(rows)
+
+
+# ---------------------------------------------------------------
+# ヒートマップ・統計api
+# ---------------------------------------------------------------
+
+
+def _cell_to_dict(cell):
+    # セル中心の経度緯度も返す（ヒートマップ描画用）
+    lng, lat = tiles.tile_to_lnglat(cell.x + 0.5, cell.y + 0.5, cell.zoom)
+    return {
+        "x": cell.x,
+        "y": cell.y,
+        "lat": lat,
+        "lng": lng,
+        "spots": cell.spots,
+        "replies": cell.replies,
+        "goods": cell.goods,
+        "bads": cell.bads,
+    }
+
+
+def _zoom_arg():
+    zoom = request.args.get("zoom", ZOOMS[-1], type=int)
+    return zoom if zoom in ZOOMS else None
+
+
+# 範囲内のセル一覧（ヒートマップ用）
+# /stats/density?zoom=12&west=140.9&south=39.8&east=141.1&north=40.0&category=観光&bucket=2025-08
+# categoryとbucketは省略すると全体の合計
+@bp_density.route("/stats/density", methods=["GET"])
+def get_density():
+    zoom = _zoom_arg()
+    if zoom is None:
+        return jsonify({"error": f"zoomは{ZOOMS}のいずれかです"}), 400
+    try:
+        west, south, east, north = (float(request.args[k]) for k in ("west", "south", "east", "north"))
+    except (KeyError, ValueError):
+        return jsonify({"error": "範囲（west, south, east, north）は必須です"}), 400
+
+    x0, y0 = tiles.lnglat_to_tile(west, north, zoom)
+    x1, y1 = tiles.lnglat_to_tile(east, south, zoom)
+    # 広すぎる範囲は返さない（ズームを下げてもらう）
+    if (int(x1) - int(x0) + 1) * (int(y1) - int(y0) + 1) > 10000:
+        return jsonify({"error": "範囲が広すぎます。zoomを小さくしてください"}), 400
+
+    cells = DensityCell.select().where(
+        DensityCell.zoom == zoom,
+        DensityCell.category == request.args.get("category", ALL),
+        DensityCell.bucket == request.args.get("bucket", ALL),
+        DensityCell.x.between(int(x0), int(x1)),
+        DensityCell.y.between(int(y0), int(y1)),
+    )
+    return jsonify({"zoom": zoom, "cells": [_cell_to_dict(cell) for cell in cells]})
+
+
+# 1セルの件数（一意インデックスで1行読むだけ）
+@bp_density.route("/stats/density/<int:zoom>/<int:x>/<int:y>", methods=["GET"])
+def get_density_cell(zoom, x, y):
+    if zoom not in ZOOMS:
+        return jsonify({"error": f"zoomは{ZOOMS}のいずれかです"}), 400
+    cell = DensityCell.get_or_none(
+        DensityCell.zoom == zoom,
+        DensityCell.category == request.args.get("category", ALL),
+        DensityCell.bucket == request.args.get("bucket", ALL),
+        DensityCell.x == x,
+        DensityCell.y == y,
+    )
+    if cell is None:
+        cell = DensityCell(zoom=zoom, x=x, y=y)
+    return jsonify({"zoom": zoom, **_cell_to_dict(cell)})
+
+
+# python density.py rebuild [ワーカー数]
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "rebuild":
+        workers = int(sys.argv[2]) if len(sys.argv) >= 3 else os.cpu_count()
+        print("cells:", rebuild(workers=workers))
+    else:
+        print("usage: python density.py rebuild [workers]")
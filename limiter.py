@@ -0,0 +1,206 @@
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from flask import flash, jsonify, redirect, request
+from flask_login import current_user
+from config import RATELIMIT_STORAGE, MAX_CONCURRENT_UPLOADS, MAX_CONCURRENT_UPLOADS_PER_USER
+import metrics
+
+# 投稿・アップロード系エンドポイントのレート制限（トークンバケット）
+# ログイン中はユーザーID毎、未ログインはIP毎にバケットを持ち、空なら429を返す
+# （会場のWi-Fiや携帯のNATでは大勢が同じIPになるので、ログイン中のユーザーをIPでまとめて制限しない）
+# SQLiteの書き込みロックとアップロード先のディスクを1クライアントに占有させないため
+
+# エンドポイント毎の制限 (1秒あたりの補充数, バケット容量)
+LIMITS = {
+    "create_spot": (1 / 30, 5),  # 30秒に1件、連続5件まで
+    "create_reply": (1 / 10, 10),
+    "create_group_reply": (1 / 10, 10),
+    # 登録は未ログインなのでIP毎　同じIPの来場者がまとめて登録しても詰まらない程度にする
+    "register": (1 / 30, 20),  # 30秒に1件、連続20件まで
+}
+
+
+class MemoryStore:
+    # プロセス内のバケット　gunicornのワーカー毎に別々になる
+    # 最近使った順に並べ、上限を超えたら一番長く使われていないバケットから捨てる（LRU）
+    # 捨てられたキーは次回満タンから始まるが、長く来ていないキーなのでほぼ満タンに戻っている
+    max_keys = 100000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def take(self, key, rate, burst, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+
+class SqliteStore:
+    # 同じホストの複数ワーカーで共有するバケット（本番でRedis等に置き換える場合も同じtakeを実装する）
+    # アプリ本体のDBとは別ファイルにして、書き込みロックを取り合わないようにする
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst, now):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+
+def _create_store(storage):
+    if storage.startswith("sqlite:"):
+        return SqliteStore(storage[len("sqlite:") :])
+    return MemoryStore()
+
+
+store = _create_store(RATELIMIT_STORAGE)
+
+
+def _client_key():
+    if current_user.is_authenticated:
+        return f"user:{current_user.id}"
+    return f"ip:{request.remote_addr}"
+
+
+def _wants_html():
+    # 画面のフォームからの送信（register）はHTMLを期待している　fetch()は*/*なのでJSONになる
+    return request.accept_mimetypes.best_match(["application/json", "text/html"]) == "text/html"
+
+
+def error_response(message, status, retry_after=None):
+    # フォームにはフラッシュメッセージを付けて元の画面へ戻し、apiにはJSONで返す
+    if _wants_html():
+        flash(message)
+        return redirect(request.url, code=303)
+    response = jsonify({"error": message})
+    response.status_code = status
+    if retry_after is not None:
+        response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def _too_many(retry_after, message):
+    return error_response(message, 429, retry_after)
+
+
+def check(name):
+    # 許可ならNone、制限中なら再試行までの秒数を返す
+    rate, burst = LIMITS[name]
+    started = time.perf_counter()
+    now = time.time()
+    allowed, wait = store.take(f"{name}:{_client_key()}", rate, burst, now)
+    retry_after = None if allowed else wait
+    metrics.inc("ratelimit_decision_seconds_total", time.perf_counter() - started, endpoint=name)
+    metrics.inc("ratelimit_requests_total", endpoint=name, result="limited" if retry_after is not None else "allowed")
+    return retry_after
+
+
+def rate_limit(name):
+    # GETは表示だけなので数えない（registerなどGET/POST兼用のルート向け）
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if request.method == "POST":
+                retry_after = check(name)
+                if retry_after is not None:
+                    return _too_many(retry_after, "リクエストが多すぎます。しばらく待ってから再度お試しください")
+            return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class _UploadSlots:
+    # 同時アップロード数の上限（プロセス全体とユーザー毎）
+    def __init__(self, total, per_client):
+        self._lock = threading.Lock()
+        self._total = total
+        self._per_client = per_client
+        self._active = 0
+        self._by_client = {}
+
+    def acquire(self, key):
+        with self._lock:
+            if self._active >= self._total or self._by_client.get(key, 0) >= self._per_client:
+                return False
+            self._active += 1
+            self._by_client[key] = self._by_client.get(key, 0) + 1
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._active -= 1
+            remaining = self._by_client[key] - 1
+            if remaining:
+                self._by_client[key] = remaining
+            else:
+                del self._by_client[key]
+
+
+upload_slots = _UploadSlots(MAX_CONCURRENT_UPLOADS, MAX_CONCURRENT_UPLOADS_PER_USER)
+
+
+@contextmanager
+def _upload_slot(key):
+    if not upload_slots.acquire(key):
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        upload_slots.release(key)
+
+
+def limit_uploads(f):
+    # multipartのリクエストだけ同時実行数を数える（request.filesを触ると本文を読み込んでしまうのでmimetypeで判定）
+    # リクエスト全体のサイズ上限はapp.config["MAX_CONTENT_LENGTH"]で413になる
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if request.method != "POST" or request.mimetype != "multipart/form-data":
+            return f(*args, **kwargs)
+        with _upload_slot(_client_key()) as acquired:
+            if not acquired:
+                metrics.inc("upload_rejected_total", endpoint=request.endpoint)
+                return _too_many(5, "アップロードが混み合っています。しばらく待ってから再度お試しください")
+            return f(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,52 @@
+import hmac
+import threading
+from collections import defaultdict
+from flask import Blueprint, Response, request
+from flask_login import current_user
+from config import ADMIN_USER_IDS, METRICS_TOKEN
+
+# プロセス内の簡易メトリクス（Prometheusのテキスト形式で/metricsから取得できる）
+# ワーカー毎の値なので、集計はPrometheus側で行う
+bp_metrics = Blueprint("metrics", __name__)
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def snapshot():
+    with _lock:
+        return dict(_counters)
+
+
+def render():
+    lines = []
+    for (name, labels), value in sorted(snapshot().items()):
+        label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+        lines.append(f"{name}{{{label_text}}} {value:g}" if label_text else f"{name} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+def _has_token():
+    # 接続元のIPはプロキシ越しだと当てにならないので、トークンで判定する
+    if not METRICS_TOKEN:
+        return False
+    auth = request.headers.get("Authorization", "")
+    return hmac.compare_digest(auth.encode("utf-8"), f"Bearer {METRICS_TOKEN}".encode("utf-8"))
+
+
+# METRICS_TOKENを持つスクレイパーか管理者のみ
+@bp_metrics.route("/metrics", methods=["GET"])
+def get_metrics():
+    is_admin = current_user.is_authenticated and current_user.id in ADMIN_USER_IDS
+    if not (_has_token() or is_admin):
+        return Response("forbidden\n", status=403, mimetype="text/plain")
+    return Response(render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,226 @@
+from flask import Blueprint, request, jsonify
+from flask_login import current_user, login_required
+from functools import wraps
+from datetime import datetime, timezone
+from peewee import chunked
+from config import db, ADMIN_USER_IDS
+from config_db import Spot, Group, Reply, Request
+import bundle
+import tiles
+import density
+import recommend
+
+# 違反報告・削除依頼（Requestテーブル）の受付と処理
+bp_moderation = Blueprint("moderation", __name__)
+
+# 報告対象にできるテーブル
+TARGET_MODELS = {"spot": Spot, "group": Group, "reply": Reply}
+
+# IN句に渡すidの上限（SQLiteの変数上限対策）
+BATCH_SIZE = 500
+
+
+def admin_required(f):
+    @wraps(f)
+    @login_required
+    def wrapper(*args, **kwargs):
+        if current_user.id not in ADMIN_USER_IDS:
+            return jsonify({"error": "権限がありません"}), 403
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+def report(table, target_id, comment=None, necessity=None):
+    # 同じ対象への未処理の報告があれば件数を増やすだけ（管理画面に同じ報告が並ばないように）
+    # 確認と書き込みの間に他の報告が入らないよう、最初から書き込みロックを取る
+    # （通常のBEGINだと同時に来た2件が読み込み後にロックを取り合い、片方がdatabase is lockedになる）
+    with db.atomic("IMMEDIATE"):
+        existing = (
+            Request.select()
+            .where(Request.table == table, Request.target_id == target_id, Request.solved == False)
+            .first()
+        )
+        if existing is None:
+            # solved_atもNoneを明示しないと作成時刻が入る
+            return Request.create(
+                table=table, target_id=target_id, comment=comment, necessity=necessity, solved_at=None
+            )
+
+        update = {Request.report_count: Request.report_count + 1}
+        if comment:
+            update[Request.comment] = comment if not existing.comment else f"{existing.comment}\n---\n{comment}"
+        if necessity:
+            # 一人でも削除が必要と判断していれば削除依頼扱い
+            update[Request.necessity] = True
+        Request.update(update).where(Request.id == existing.id).execute()
+        return existing
+
+
+def _soft_delete(table, target_ids, now):
+    # 対象と、それにぶら下がるデータをまとめて論理削除する
+    # 戻り値: キャッシュ無効化が必要なspotとgroupのid
+    spot_ids, group_ids = set(), set()
+    for ids in chunked(target_ids, BATCH_SIZE):
+        if table == "spot":
+            # 密度グリッドは削除済みを数えないので、消す前の件数を引く
+            density.remove_spots(ids)
+            Spot.update(deleted_at=now).where(Spot.id.in_(ids), Spot.deleted_at.is_null()).execute()
+            Reply.update(deleted_at=now).where(Reply.spot.in_(ids), Reply.deleted_at.is_null()).execute()
+            # グループとの紐付け（GroupSpot）は残す　表示側がSpot.deleted_atで除外するので、
+            # 削除を取り消せば元のグループに戻り、期間が過ぎればarchive.pyがspotと一緒に移す
+            # （所属グループのバンドルは_invalidateで紐付けから引いて無効化する）
+            spot_ids.update(ids)
+        elif table == "group":
+            Group.update(deleted_at=now).where(Group.id.in_(ids), Group.deleted_at.is_null()).execute()
+            Reply.update(deleted_at=now).where(Reply.group.in_(ids), Reply.deleted_at.is_null()).execute()
+            group_ids.update(ids)
+        elif table == "reply":
+            for spot_id, group_id in Reply.select(Reply.spot, Reply.group).where(Reply.id.in_(ids)).tuples():
+                if spot_id is not None:
+                    spot_ids.add(spot_id)
+                if group_id is not None:
+                    group_ids.add(group_id)
+            density.remove_replies(ids)
+            Reply.update(deleted_at=now).where(Reply.id.in_(ids), Reply.deleted_at.is_null()).execute()
+    return spot_ids, group_ids
+
+
+def _invalidate(table, spot_ids, group_ids):
+    # コミット後にまとめてキャッシュを無効化する
+    if table == "group":
+        for group_id in group_ids:
+            bundle.remove_group(group_id)
+        return
+    for group_id in group_ids:
+        bundle.invalidate_group(group_id)
+    for ids in chunked(spot_ids, BATCH_SIZE):
+        bundle.invalidate_groups_for_spots(ids)
+        if table == "spot":
+            tiles.invalidate_spots(ids)
+        recommend.mark_stale_spots(ids)
+
+
+def resolve(request_ids, delete):
+    # 報告をまとめて処理する　delete=Trueなら対象を論理削除、Falseなら却下
+    # 同じ対象への他の未処理報告も一緒に解決済みにする
+    now = datetime.now(timezone.utc)
+    invalidations = []
+    resolved = 0
+    # 読み込み（報告・密度グリッド）から始まるので、最初に書き込みロックを取る（report()と同じ理由）
+    with db.atomic("IMMEDIATE"):
+        targets = {}
+        for ids in chunked(request_ids, BATCH_SIZE):
+            for table, target_id in (
+                Request.select(Request.table, Request.target_id)
+                .where(Request.id.in_(ids), Request.solved == False)
+                .tuples()
+            ):
+                targets.setdefault(table, set()).add(target_id)
+
+        for table, target_ids in targets.items():
+            target_ids = sorted(target_ids)
+            if delete and table in TARGET_MODELS:
+                spot_ids, group_ids = _soft_delete(table, target_ids, now)
+                invalidations.append((table, spot_ids, group_ids))
+            for ids in chunked(target_ids, BATCH_SIZE):
+                resolved += (
+                    Request.update(solved=True, solved_at=now, resolution="delete" if delete else "dismiss")
+                    .where(Request.table == table, Request.target_id.in_(ids), Request.solved == False)
+                    .execute()
+                )
+
+    for table, spot_ids, group_ids in invalidations:
+        _invalidate(table, spot_ids, group_ids)
+    return resolved
+
+
+# 違反報告・削除依頼の登録
+# body: JSON.stringify({ table: 'spot', target_id: spot.id, comment, necessity })
+@bp_moderation.route("/requests", methods=["POST"])
+@login_required
+def create_request():
+    data = request.get_json(silent=True) or request.form
+    table = data.get("table")
+    target_id = data.get("target_id")
+    comment = (data.get("comment") or "").strip() or None
+    necessity = data.get("necessity") in (True, "true", "1", 1)
+
+    if table not in TARGET_MODELS:
+        return jsonify({"error": "報告対象が不正です"}), 400
+    try:
+        target_id = int(target_id)
+    except (TypeError, ValueError):
+        return jsonify({"error": "報告対象が不正です"}), 400
+
+    model = TARGET_MODELS[table]
+    if not model.select().where(model.id == target_id, model.deleted_at.is_null()).exists():
+        return jsonify({"error": "報告対象が見つかりません"}), 404
+
+    report(table, target_id, comment=comment, necessity=necessity)
+    return jsonify({"success": True})
+
+
+# 管理者用の報告一覧　未処理のものを新しい順に返す
+# 件数が多くてもOFFSETを使わず、前ページ最後のidから続きを取る（?before=<id>）
+@bp_moderation.route("/admin/requests", methods=["GET"])
+@admin_required
+def list_requests():
+    solved = request.args.get("solved", "0") == "1"
+    limit = max(1, min(request.args.get("limit", 50, type=int), 200))
+    before = request.args.get("before", type=int)
+
+    query = Request.select().where(Request.solved == solved)
+    if before is not None:
+        query = query.where(Request.id < before)
+    rows = list(query.order_by(Request.id.desc()).limit(limit))
+
+    # 対象のタイトルはテーブル毎にまとめて取得
+    titles = {}
+    for table, model in TARGET_MODELS.items():
+        ids = [row.target_id for row in rows if row.table == table]
+        if not ids:
+            continue
+        field = model.comment if table == "reply" else model.title
+        for target_id, title in model.select(model.id, field).where(model.id.in_(ids)).tuples():
+            titles[(table, target_id)] = title
+
+    return jsonify(
+        {
+            "requests": [
+                {
+                    "id": row.id,
+                    "table": row.table,
+                    "target_id": row.target_id,
+                    "target_title": titles.get((row.table, row.target_id)),
+                    "comment": row.comment,
+                    "necessity": row.necessity,
+                    "resolution": row.resolution,
+                    "report_count": row.report_count,
+                    "solved": row.solved,
+                    "date": row.date.strftime("%Y-%m-%d %H:%M") if row.date else None,
+                }
+                for row in rows
+            ],
+            "next_before": rows[-1].id if len(rows) == limit else None,
+        }
+    )
+
+
+# 管理者による一括処理
+# body: JSON.stringify({ ids: [1, 2, 3], action: 'delete' })  actionは'delete'か'dismiss'
+@bp_moderation.route("/admin/requests/resolve", methods=["POST"])
+@admin_required
+def resolve_requests():
+    data = request.get_json(silent=True) or {}
+    action = data.get("action")
+    try:
+        ids = [int(x) for x in data.get("ids", [])]
+    except (TypeError, ValueError):
+        return jsonify({"error": "idが不正です"}), 400
+
+    if action not in ("delete", "dismiss") or not ids:
+        return jsonify({"error": "処理内容が不正です"}), 400
+
+    resolved = resolve(ids, delete=action == "delete")
+    return jsonify({"success": True, "resolved": resolved})
@@ -0,0 +1,184 @@
+import os
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from peewee import chunked
+from config import db, UPLOAD_DIR
+from config_db import User, Spot, SpotImage, Reply, ReplyImage, Group, GroupImage, StorageUsage
+import archive
+
+# アップロードファイルの掃除と使用量の集計
+# UPLOAD_DIRをos.scandirで順に読み（全件のリストは作らない）、一定数ずつDBの参照と突き合わせる
+# どこからも参照されていないファイルは一旦.quarantineへ移し、猶予期間が過ぎたら削除する
+#   python reaper.py            掃除と集計
+#   python reaper.py --dry-run  何が対象になるかだけ表示
+
+QUARANTINE_DIR = os.path.join(UPLOAD_DIR, ".quarantine")
+BATCH_SIZE = 500
+# 作られたばかりのファイルはアップロード処理の途中かもしれないので触らない
+MIN_AGE = timedelta(hours=1)
+# 論理削除されたspot・リプライ等の画像は、削除からこの期間が過ぎたら不要とみなす
+DELETED_GRACE = timedelta(days=30)
+# 隔離してから完全に削除するまでの期間（誤判定に気づいたら戻せるように）
+QUARANTINE_DAYS = timedelta(days=7)
+
+
+def _live(model, deleted_before):
+    # 論理削除されていないか、削除されてから猶予期間内のもの
+    return model.deleted_at.is_null() | (model.deleted_at >= deleted_before)
+
+
+def _refs_spot(names, deleted_before):
+    return (
+        SpotImage.select(SpotImage.path, Spot.user)
+        .join(Spot)
+        .where(SpotImage.path.in_(names), _live(Spot, deleted_before))
+        .tuples()
+    )
+
+
+def _refs_reply(names, deleted_before):
+    return (
+        ReplyImage.select(ReplyImage.path, Reply.user)
+        .join(Reply)
+        .where(ReplyImage.path.in_(names), _live(Reply, deleted_before))
+        .tuples()
+    )
+
+
+def _refs_group(names, deleted_before):
+    return (
+        GroupImage.select(GroupImage.path, Group.user)
+        .join(Group)
+        .where(GroupImage.path.in_(names), _live(Group, deleted_before))
+        .tuples()
+    )
+
+
+def _refs_icon(names, deleted_before):
+    return User.select(User.icon, User.id).where(User.icon.in_(names), _live(User, deleted_before)).tuples()
+
+
+# アップロード先のフォルダ名 → ファイル名から参照元を引く関数
+KINDS = {
+    "spot": _refs_spot,
+    "reply": _refs_reply,
+    "group": _refs_group,
+    "icon": _refs_icon,
+}
+
+
+# archive.pyで別ファイルへ移した行の参照も数える（アイコンのusersは移さない）
+ARCHIVED = {
+    "spot": (SpotImage, Spot),
+    "reply": (ReplyImage, Reply),
+    "group": (GroupImage, Group),
+}
+
+
+def _owners(kind, names, deleted_before):
+    # ファイル名 → 所有ユーザーid（参照が生きているもののみ）
+    owners = dict(KINDS[kind](names, deleted_before))
+    if kind in ARCHIVED:
+        rest = [name for name in names if name not in owners]
+        owners.update(archive.archived_image_owners(*ARCHIVED[kind], rest, deleted_before))
+    return owners
+
+
+def _batches(directory, min_mtime):
+    # (名前, サイズ)をBATCH_SIZE件ずつ返す　作られたばかりのファイルは飛ばす
+    batch = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            if stat.st_mtime > min_mtime:
+                continue
+            batch.append((entry.name, stat.st_size))
+            if len(batch) >= BATCH_SIZE:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def _quarantine(kind, name, dry_run):
+    if dry_run:
+        return
+    target_dir = os.path.join(QUARANTINE_DIR, kind)
+    os.makedirs(target_dir, exist_ok=True)
+    target = os.path.join(target_dir, name)
+    os.replace(os.path.join(UPLOAD_DIR, kind, name), target)
+    # 隔離した時刻をmtimeに残して、猶予期間の判定に使う
+    os.utime(target)
+
+
+def _purge(now, dry_run, report):
+    # 猶予期間の過ぎた隔離ファイルを消す　その間に参照が復活していたら元に戻す
+    deleted_before = datetime.now(timezone.utc) - DELETED_GRACE
+    for kind in KINDS:
+        directory = os.path.join(QUARANTINE_DIR, kind)
+        if not os.path.isdir(directory):
+            continue
+        for batch in _batches(directory, now - QUARANTINE_DAYS.total_seconds()):
+            owners = _owners(kind, [name for name, _ in batch], deleted_before)
+            for name, size in batch:
+                path = os.path.join(directory, name)
+                if name in owners:
+                    report["restored"] += 1
+                    if not dry_run:
+                        os.replace(path, os.path.join(UPLOAD_DIR, kind, name))
+                    continue
+                report["deleted_files"] += 1
+                report["deleted_bytes"] += size
+                if not dry_run:
+                    os.remove(path)
+
+
+def run(dry_run=False):
+    now = time.time()
+    deleted_before = datetime.now(timezone.utc) - DELETED_GRACE
+    usage = defaultdict(lambda: [0, 0])  # (kind, user) → [files, bytes]
+    report = defaultdict(int)
+
+    for kind in KINDS:
+        directory = os.path.join(UPLOAD_DIR, kind)
+        if not os.path.isdir(directory):
+            continue
+        for batch in _batches(directory, now - MIN_AGE.total_seconds()):
+            owners = _owners(kind, [name for name, _ in batch], deleted_before)
+            for name, size in batch:
+                if name in owners:
+                    counter = usage[(kind, owners[name])]
+                    counter[0] += 1
+                    counter[1] += size
+                    continue
+                report["quarantined_files"] += 1
+                report["quarantined_bytes"] += size
+                if dry_run:
+                    print("orphan:", os.path.join(kind, name))
+                _quarantine(kind, name, dry_run)
+
+    _purge(now, dry_run, report)
+
+    if not dry_run:
+        with db.atomic():
+            StorageUsage.delete().execute()
+            rows = [
+                {"kind": kind, "user": user_id, "files": files, "bytes": size}
+                for (kind, user_id), (files, size) in usage.items()
+            ]
+            for batch in chunked(rows, 100):
+                StorageUsage.insert_many(batch).execute()
+    return dict(report)
+
+
+def usage_for_user(user_id):
+    # 容量制限の判定用　{kind: bytes}（前回の走査時点）
+    return dict(StorageUsage.select(StorageUsage.kind, StorageUsage.bytes).where(StorageUsage.user == user_id).tuples())
+
+
+if __name__ == "__main__":
+    print(run(dry_run="--dry-run" in sys.argv))
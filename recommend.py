@@ -0,0 +1,257 @@
+import json
+import math
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from flask import Blueprint, jsonify
+from peewee import JOIN, chunked, fn
+from config import db
+from config_db import Spot, Tag, SpotTag, SpotGood, SpotBad, Reply, DensityCell, SpotRecommendation
+import density
+import tiles
+from utils import calculate_distance
+
+# 「近くの空いている似たspot」のおすすめ
+# 似ている: 共通のタグ（SpotTag）とカテゴリー　混雑: そのspotと周辺セルのリプライ・リアクション数
+# クリックのたびに計算するとjoinだらけになるので、バックグラウンドで計算してspot毎に保存しておく
+#   python recommend.py          staleなものを一通り再計算
+#   python recommend.py watch 60 60秒おきに再計算を繰り返す
+bp_recommend = Blueprint("recommend", __name__)
+
+RADIUS_KM = 5.0
+MAX_RESULTS = 10
+# カテゴリーが同じならタグの一致度にこれを足す
+CATEGORY_WEIGHT = 0.5
+# 近い対象spotをまとめて処理する単位（このズームのタイル毎に候補を1回で取得する）
+GROUP_ZOOM = 12
+BATCH_SIZE = 500
+
+
+def _bbox(lat, lng, radius_km):
+    # 半径radius_kmの円を含む緯度経度の範囲（lat/lngインデックスで絞り込むため）
+    dlat = radius_km / 111.0
+    dlng = radius_km / (111.0 * max(math.cos(math.radians(lat)), 0.01))
+    return lat - dlat, lat + dlat, lng - dlng, lng + dlng
+
+
+def _in_bbox(south, north, west, east):
+    return (
+        Spot.lat.between(south, north),
+        Spot.lng.between(west, east),
+        Spot.deleted_at.is_null(),
+    )
+
+
+# ---------------------------------------------------------------
+# 再計算が必要なspotに印をつける
+# ---------------------------------------------------------------
+
+
+def mark_stale_around(points):
+    # points: [(lat, lng)]　周辺のspotのおすすめは候補や混雑度が変わるので再計算させる
+    for lat, lng in points:
+        south, north, west, east = _bbox(float(lat), float(lng), RADIUS_KM)
+        nearby = Spot.select(Spot.id).where(*_in_bbox(south, north, west, east))
+        # 既にstaleな行は書き換えない（密集地では書き込み毎に数千行になり、書き込みロックを長く握る）
+        SpotRecommendation.update(stale=True).where(
+            SpotRecommendation.spot.in_(nearby), SpotRecommendation.stale == False
+        ).execute()
+
+
+def mark_stale_spots(spot_ids):
+    # 削除されたspot自身も対象にする（再計算時に結果ごと消える）
+    for batch in chunked(spot_ids, BATCH_SIZE):
+        SpotRecommendation.update(stale=True).where(
+            SpotRecommendation.spot.in_(batch), SpotRecommendation.stale == False
+        ).execute()
+        points = Spot.select(Spot.lat, Spot.lng).where(Spot.id.in_(batch)).tuples()
+        mark_stale_around(points)
+
+
+# ---------------------------------------------------------------
+# 計算
+# ---------------------------------------------------------------
+
+
+def _load_details(spot_ids):
+    # 候補spotのタグとリプライ・リアクション数をまとめて取得
+    tags = defaultdict(set)
+    activity = defaultdict(int)
+    for batch in chunked(spot_ids, BATCH_SIZE):
+        for spot_id, name in SpotTag.select(SpotTag.spot, Tag.name).join(Tag).where(SpotTag.spot.in_(batch)).tuples():
+            tags[spot_id].add(name)
+        counts = [
+            Reply.select(Reply.spot, fn.COUNT(Reply.id)).where(Reply.spot.in_(batch), Reply.deleted_at.is_null()),
+            SpotGood.select(SpotGood.spot, fn.COUNT(SpotGood.id)).where(SpotGood.spot.in_(batch)),
+            SpotBad.select(SpotBad.spot, fn.COUNT(SpotBad.id)).where(SpotBad.spot.in_(batch)),
+        ]
+        for query in counts:
+            for spot_id, count in query.group_by(query.model.spot).tuples():
+                activity[spot_id] += count
+    return tags, activity
+
+
+def _cell_activity(cells):
+    # 周辺（密度グリッドの最小セル）の混み具合
+    zoom = density.ZOOMS[-1]
+    result = {}
+    for batch in chunked(list(cells), BATCH_SIZE // 2):
+        # x, yそれぞれのINなので余分なセルも返るが、呼び出し側はキーで引くだけなので問題ない
+        query = DensityCell.select(
+            DensityCell.x, DensityCell.y, DensityCell.spots, DensityCell.replies, DensityCell.goods, DensityCell.bads
+        ).where(
+            DensityCell.zoom == zoom,
+            DensityCell.category == density.ALL,
+            DensityCell.bucket == density.ALL,
+            DensityCell.x.in_({x for x, _ in batch}),
+            DensityCell.y.in_({y for _, y in batch}),
+        )
+        for x, y, spots, replies, goods, bads in query.tuples():
+            result[(x, y)] = spots + replies + goods + bads
+    return result
+
+
+def _cell_of(lat, lng):
+    fx, fy = tiles.lnglat_to_tile(float(lng), float(lat), density.ZOOMS[-1])
+    return int(fx), int(fy)
+
+
+def _compute_group(targets):
+    # targets: 近くにある対象spotのリスト [(id, lat, lng, category, title)]
+    # 全対象の半径を含む範囲の候補を1回で取る
+    boxes = [_bbox(lat, lng, RADIUS_KM) for _, lat, lng, _, _ in targets]
+    south, north = min(b[0] for b in boxes), max(b[1] for b in boxes)
+    west, east = min(b[2] for b in boxes), max(b[3] for b in boxes)
+    candidates = list(
+        Spot.select(Spot.id, Spot.lat, Spot.lng, Spot.category, Spot.title)
+        .where(*_in_bbox(south, north, west, east))
+        .tuples()
+    )
+    ids = [c[0] for c in candidates]
+    tags, activity = _load_details(ids)
+    cells = {c[0]: _cell_of(c[1], c[2]) for c in candidates}
+    cell_activity = _cell_activity(set(cells.values()))
+
+    def crowding(spot_id):
+        return activity[spot_id] + cell_activity.get(cells[spot_id], 0)
+
+    results = {}
+    for spot_id, lat, lng, category, _ in targets:
+        my_tags = tags[spot_id]
+        my_crowding = crowding(spot_id)
+        scored = []
+        for other_id, other_lat, other_lng, other_category, other_title in candidates:
+            if other_id == spot_id:
+                continue
+            other_crowding = crowding(other_id)
+            if other_crowding >= my_crowding:
+                continue
+            shared = my_tags & tags[other_id]
+            union = my_tags | tags[other_id]
+            similarity = len(shared) / len(union) if union else 0
+            if other_category == category:
+                similarity += CATEGORY_WEIGHT
+            if similarity <= 0:
+                continue
+            distance = calculate_distance(float(lat), float(lng), float(other_lat), float(other_lng))
+            if distance > RADIUS_KM:
+                continue
+            scored.append(
+                (
+                    -similarity,
+                    other_crowding,
+                    distance,
+                    {
+                        "id": other_id,
+                        "title": other_title,
+                        "lat": float(other_lat),
+                        "lng": float(other_lng),
+                        "category": other_category,
+                        "distance_km": round(distance, 2),
+                        "shared_tags": sorted(shared),
+                        "crowding": other_crowding,
+                        "score": round(similarity, 3),
+                    },
+                )
+            )
+        scored.sort(key=lambda s: s[:3])
+        results[spot_id] = [s[3] for s in scored[:MAX_RESULTS]]
+    return results
+
+
+def refresh(spot_ids):
+    # 指定したspotのおすすめを計算して保存する
+    targets = list(
+        Spot.select(Spot.id, Spot.lat, Spot.lng, Spot.category, Spot.title)
+        .where(Spot.id.in_(spot_ids), Spot.deleted_at.is_null())
+        .tuples()
+    )
+    # 削除されたspotの結果は消す
+    deleted = set(spot_ids) - {target[0] for target in targets}
+    for batch in chunked(deleted, BATCH_SIZE):
+        SpotRecommendation.delete().where(SpotRecommendation.spot.in_(batch)).execute()
+
+    groups = defaultdict(list)
+    for target in targets:
+        fx, fy = tiles.lnglat_to_tile(float(target[2]), float(target[1]), GROUP_ZOOM)
+        groups[(int(fx), int(fy))].append(target)
+
+    now = datetime.now(timezone.utc)
+    for group in groups.values():
+        results = _compute_group(group)
+        with db.atomic():
+            for spot_id, alternatives in results.items():
+                SpotRecommendation.insert(
+                    spot=spot_id, alternatives=json.dumps(alternatives, ensure_ascii=False), stale=False, updated=now
+                ).on_conflict(
+                    conflict_target=[SpotRecommendation.spot],
+                    preserve=[SpotRecommendation.alternatives, SpotRecommendation.stale, SpotRecommendation.updated],
+                ).execute()
+    return len(targets)
+
+
+def refresh_stale(limit=BATCH_SIZE):
+    # staleなものと、まだ計算していないspotを処理する　処理件数を返す
+    missing = (
+        Spot.select(Spot.id)
+        .join(SpotRecommendation, JOIN.LEFT_OUTER)
+        .where(SpotRecommendation.id.is_null(), Spot.deleted_at.is_null())
+        .limit(limit)
+    )
+    stale = SpotRecommendation.select(SpotRecommendation.spot).where(SpotRecommendation.stale == True).limit(limit)
+    spot_ids = [row.id for row in missing] + [row.spot_id for row in stale]
+    if spot_ids:
+        refresh(spot_ids)
+    return len(spot_ids)
+
+
+def run():
+    total = 0
+    while True:
+        count = refresh_stale()
+        if not count:
+            return total
+        total += count
+
+
+# あるspotの代わりになる、近くの空いている似たspot（保存済みの結果を1行読むだけ）
+@bp_recommend.route("/spots/<int:spot_id>/alternatives", methods=["GET"])
+def get_alternatives(spot_id):
+    row = SpotRecommendation.get_or_none(SpotRecommendation.spot == spot_id)
+    if row is None:
+        if not Spot.select().where(Spot.id == spot_id, Spot.deleted_at.is_null()).exists():
+            return jsonify({"error": "spotが見つかりません"}), 404
+        # まだ計算されていない（バックグラウンドで計算待ち）
+        return jsonify({"spot_id": spot_id, "alternatives": [], "pending": True})
+    return jsonify({"spot_id": spot_id, "alternatives": json.loads(row.alternatives), "pending": row.stale})
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "watch":
+        interval = int(sys.argv[2]) if len(sys.argv) >= 3 else 60
+        while True:
+            print("refreshed:", run())
+            time.sleep(interval)
+    else:
+        print("refreshed:", run())
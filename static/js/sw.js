@@ -0,0 +1,69 @@
+// グループ表示のオフライン対応
+// QRコードからグループを開いた時に /groups/{id}/manifest.json のprecacheを保存しておき、
+// 会場で電波が弱くてもspot一覧と画像を表示できるようにする（地図の背景はMapboxから取得するので対象外）
+
+const CACHE_PREFIX = 'group-';
+
+self.addEventListener('install', () => self.skipWaiting());
+self.addEventListener('activate', (event) => event.waitUntil(self.clients.claim()));
+
+// ページから { type: 'precache', groupId } が送られてきたらマニフェストの一覧を保存する
+self.addEventListener('message', (event) => {
+    const data = event.data || {};
+    if (data.type === 'precache') {
+        event.waitUntil(precacheGroup(data.groupId));
+    }
+});
+
+async function precacheGroup(groupId) {
+    const res = await fetch(`/groups/${groupId}/manifest.json`, { cache: 'no-cache' });
+    if (!res.ok) return;
+    const manifest = await res.json();
+    const cache = await caches.open(CACHE_PREFIX + groupId);
+    const bundleUrl = `/groups/${groupId}/bundle/${manifest.version}.json`;
+    if (await cache.match(bundleUrl)) return; // 同じversionは保存済み
+
+    // 1件失敗しても残りは保存する（addAllは全部失敗扱いになるので使わない）
+    await Promise.allSettled([...manifest.precache, `/groups/${groupId}`].map(url => cache.add(url)));
+
+    // 古いversionのバンドルは消す
+    for (const req of await cache.keys()) {
+        const path = new URL(req.url).pathname;
+        if (path.startsWith(`/groups/${groupId}/bundle/`) && path !== bundleUrl) {
+            await cache.delete(req);
+        }
+    }
+}
+
+self.addEventListener('fetch', (event) => {
+    const req = event.request;
+    if (req.method !== 'GET') return;
+    const url = new URL(req.url);
+    if (url.origin !== self.location.origin) return;
+
+    // グループの表示と最新データはネットワーク優先、繋がらなければ保存済みのものを返す
+    const group = url.pathname.match(/^\/groups\/(\d+)(\/view)?$/);
+    if (group) {
+        event.respondWith(networkFirst(req, CACHE_PREFIX + group[1]));
+        return;
+    }
+    // version付きバンドルと画像は中身が変わらないので保存済みを優先
+    if (/^\/groups\/\d+\/bundle\/[0-9a-f]+\.json$/.test(url.pathname) || url.pathname.startsWith('/uploads/')) {
+        event.respondWith(caches.match(req).then(hit => hit || fetch(req)));
+    }
+});
+
+async function networkFirst(req, cacheName) {
+    try {
+        const res = await fetch(req);
+        if (res.ok) {
+            const cache = await caches.open(cacheName);
+            await cache.put(req, res.clone());
+        }
+        return res;
+    } catch (err) {
+        const hit = await caches.match(req);
+        if (hit) return hit;
+        throw err;
+    }
+}
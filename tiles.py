@@ -0,0 +1,192 @@
+import math
+import os
+from config import TILE_DIR
+from config_db import Spot
+from utils import write_atomic, read_text
+
+# Mapbox Vector Tile (MVT) の生成とディスクキャッシュ
+# 地図のパン・ズームではid, category, titleだけを載せた小さなバイナリを返し、
+# 詳細はクリック時に/spots/<id>から取得する
+# キャッシュ: TILE_DIR/v{TILE_VERSION}/{z}/{x}/{y}.mvt
+#   spotが追加・削除されたら、その地点を含むタイルだけを各ズームで消す
+#   TILE_VERSIONはタイルの中身（属性やextent）を変えた時に上げる
+
+TILE_VERSION = 1
+LAYER_NAME = "spots"
+EXTENT = 4096
+# タイル境界付近のピンが切れないように隣のタイルにも少しはみ出して載せる
+BUFFER = 64
+# これより大きいズームはmapbox側でこのズームのタイルを拡大表示する
+MAX_ZOOM = 14
+# 1タイルに載せる上限（広域表示で全件載せないように新しい順で打ち切る）
+MAX_FEATURES = 2000
+
+
+# ---------------------------------------------------------------
+# タイル座標の計算
+# ---------------------------------------------------------------
+
+
+def lnglat_to_tile(lng, lat, z):
+    # 経度緯度 → ズームzでのタイル座標（小数）　Webメルカトル
+    n = 2**z
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = (lng + 180.0) / 360.0 * n
+    y = (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n
+    return x, y
+
+
+def tile_to_lnglat(x, y, z):
+    n = 2**z
+    lng = x / n * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lng, lat
+
+
+def tile_bounds(z, x, y, buffer=0.0):
+    # (west, south, east, north)　bufferはタイル単位
+    west, north = tile_to_lnglat(x - buffer, y - buffer, z)
+    east, south = tile_to_lnglat(x + 1 + buffer, y + 1 + buffer, z)
+    return west, south, east, north
+
+
+def tiles_for_point(lng, lat, z):
+    # この地点を載せているタイル（バッファで隣接タイルに載る分も含む）
+    fx, fy = lnglat_to_tile(lng, lat, z)
+    b = BUFFER / EXTENT
+    n = 2**z
+    xs = range(max(0, math.floor(fx - b)), min(n - 1, math.floor(fx + b)) + 1)
+    ys = range(max(0, math.floor(fy - b)), min(n - 1, math.floor(fy + b)) + 1)
+    return [(x, y) for x in xs for y in ys]
+
+
+# ---------------------------------------------------------------
+# MVT（protobuf）のエンコード　ライブラリを入れるほどではないので必要な分だけ手書き
+# https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+# ---------------------------------------------------------------
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 31)
+
+
+def _field(number, wire_type, payload):
+    # wire_type 0: varint, 2: length-delimited
+    key = _varint((number << 3) | wire_type)
+    if wire_type == 0:
+        return key + _varint(payload)
+    return key + _varint(len(payload)) + payload
+
+
+def _packed(number, values):
+    return _field(number, 2, b"".join(_varint(v) for v in values))
+
+
+def encode_layer(features):
+    # features: [(id, x, y, {key: str})]　x, yはタイル内ピクセル座標
+    keys, values = {}, {}
+    body = bytearray()
+    for feature_id, x, y, properties in features:
+        tags = []
+        for key, value in properties.items():
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault(value, len(values)))
+        # 点ジオメトリ: MoveTo(1)を1回 → (1 & 0x7) | (1 << 3) = 9
+        geometry = [9, _zigzag(x), _zigzag(y)]
+        feature = _field(1, 0, feature_id) + _packed(2, tags) + _field(3, 0, 1) + _packed(4, geometry)
+        body += _field(2, 2, feature)
+
+    layer = _field(15, 0, 2) + _field(1, 2, LAYER_NAME.encode("utf-8")) + bytes(body)
+    for key in keys:
+        layer += _field(3, 2, key.encode("utf-8"))
+    for value in values:
+        layer += _field(4, 2, _field(1, 2, value.encode("utf-8")))
+    layer += _field(5, 0, EXTENT)
+    # Tile.layers = 3
+    return _field(3, 2, layer)
+
+
+def render_tile(z, x, y):
+    west, south, east, north = tile_bounds(z, x, y, buffer=BUFFER / EXTENT)
+    # lat/lngのインデックスで範囲を絞ってから座標変換する
+    query = (
+        Spot.select(Spot.id, Spot.lat, Spot.lng, Spot.category, Spot.title)
+        .where(
+            Spot.lat.between(south, north),
+            Spot.lng.between(west, east),
+            Spot.deleted_at.is_null(),
+        )
+        .order_by(Spot.date.desc())
+        .limit(MAX_FEATURES)
+        .tuples()
+    )
+    features = []
+    for spot_id, lat, lng, category, title in query:
+        fx, fy = lnglat_to_tile(float(lng), float(lat), z)
+        px = round((fx - x) * EXTENT)
+        py = round((fy - y) * EXTENT)
+        features.append((spot_id, px, py, {"category": category, "title": title}))
+    return encode_layer(features) if features else b""
+
+
+# ---------------------------------------------------------------
+# ディスクキャッシュ
+# ---------------------------------------------------------------
+
+
+def _tile_path(z, x, y):
+    return os.path.join(TILE_DIR, f"v{TILE_VERSION}", str(z), str(x), f"{y}.mvt")
+
+
+def _read_stamp():
+    return read_text(os.path.join(TILE_DIR, "stamp"))
+
+
+def cached_tile_path(z, x, y):
+    path = _tile_path(z, x, y)
+    return os.path.abspath(path) if os.path.exists(path) else None
+
+
+def build_tile(z, x, y):
+    # タイルを生成してキャッシュに保存する
+    stamp = _read_stamp()
+    data = render_tile(z, x, y)
+    # 生成中にspotが追加・削除された場合は古い内容かもしれないので保存しない
+    if _read_stamp() == stamp:
+        path = _tile_path(z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, data)
+    return data
+
+
+def invalidate_points(points):
+    # points: [(lat, lng)]　各ズームでその地点を含むタイルだけ消す
+    points = list(points)
+    if not points:
+        return
+    write_atomic(os.path.join(TILE_DIR, "stamp"), os.urandom(8).hex())
+    for lat, lng in points:
+        for z in range(MAX_ZOOM + 1):
+            for x, y in tiles_for_point(float(lng), float(lat), z):
+                try:
+                    os.remove(_tile_path(z, x, y))
+                except FileNotFoundError:
+                    pass
+
+
+def invalidate_spots(spot_ids):
+    spot_ids = list(spot_ids)
+    if spot_ids:
+        invalidate_points(Spot.select(Spot.lat, Spot.lng).where(Spot.id.in_(spot_ids)).tuples())
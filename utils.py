@@ -0,0 +1,39 @@
+import math
+import os
+import threading
+
+# 複数のモジュールで使う小さな関数
+
+
+def calculate_distance(lat1, lng1, lat2, lng2):
+    # Haversine公式で距離計算（km） 引数は二点の緯度経度　出力は距離
+    dlat = math.radians(lat2 - lat1)
+    dlng = math.radians(lng2 - lng1)
+    a = (
+        math.sin(dlat / 2) ** 2
+        + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlng / 2) ** 2
+    )
+    dist = 6371 * 2 * math.asin(math.sqrt(a))
+    return dist
+
+
+def write_atomic(path, data):
+    # 一時ファイルに書いてからreplaceすることで読みかけのファイルを配信しない
+    # dataがbytesならバイナリ、strならUTF-8で書く
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if isinstance(data, bytes):
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+    else:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+    os.replace(tmp_path, path)
+
+
+def read_text(path):
+    # ファイルがなければNone
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
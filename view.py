@@ -1,10 +1,15 @@
-from flask import Blueprint, render_template, request, jsonify
+from flask import Blueprint, Response, current_app, render_template, request, jsonify, send_file, redirect, url_for
 from flask_login import current_user, login_required
-import math
 import os
 from datetime import datetime
 from werkzeug.utils import secure_filename
-from config import UPLOAD_DIR
+from config import UPLOAD_DIR, db
+import bundle
+import tiles
+import density
+import recommend
+from limiter import rate_limit, limit_uploads
+from utils import calculate_distance
 from config_db import (
     # User,
     Spot,
@@ -13,9 +18,9 @@ from config_db import (
     SpotTag,
     Reply,
     ReplyImage,
-    Group,
-    GroupSpot,
-    GroupTag,
+    # Group,
+    # GroupSpot,
+    # GroupTag,
     # SpotGood,
     # SpotBad,
     # SpotSolved,
@@ -28,17 +33,26 @@ from config_db import (
 bp_view = Blueprint("view", __name__)
 
 
-def calculate_distance(lat1, lng1, lat2, lng2):
-    # Haversine公式で距離計算（km） 引数は二点の緯度経度　出力は距離
-    # spotの読み込み範囲を決めるための関数
-    dlat = math.radians(lat2 - lat1)
-    dlng = math.radians(lng2 - lng1)
-    a = (
-        math.sin(dlat / 2) ** 2
-        + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlng / 2) ** 2
-    )
-    dist = 6371 * 2 * math.asin(math.sqrt(a))
-    return dist
+def spot_to_dict(spot):
+    # タグ取得
+    tags = [tag.name for tag in Tag.select().join(SpotTag).where(SpotTag.spot == spot)]
+
+    # スポット画像取得（HTML側の対応が間に合わないので最初の1枚のみ）
+    images = [img.path for img in spot.images]  # SpotImageテーブルから画像パス取得
+
+    return {
+        "id": spot.id,
+        "title": spot.title,
+        "lat": float(spot.lat),
+        "lng": float(spot.lng),
+        "category": spot.category,
+        "user_name": spot.user.name,
+        "user_icon": spot.user.icon,
+        "date": spot.date.strftime("%Y-%m-%d %H:%M"),
+        "comment": spot.comment,
+        "tags": tags,
+        "images": images,
+    }
 
 
 # 初期ページ
@@ -78,27 +92,7 @@ def get_spots():
         distance = calculate_distance(center_lat, center_lng, float(spot.lat), float(spot.lng))
         # spot.latは文字列だから注意
         if distance <= radius:
-            # タグ取得
-            tags = [tag.name for tag in Tag.select().join(SpotTag).where(SpotTag.spot == spot)]
-
-            # スポット画像取得（HTML側の対応が間に合わないので最初の1枚のみ）
-            images = [img.path for img in spot.images]  # SpotImageテーブルから画像パス取得
-
-            spot_list.append(
-                {
-                    "id": spot.id,
-                    "title": spot.title,
-                    "lat": float(spot.lat),
-                    "lng": float(spot.lng),
-                    "category": spot.category,
-                    "user_name": spot.user.name,
-                    "user_icon": spot.user.icon,
-                    "date": spot.date.strftime("%Y-%m-%d %H:%M"),
-                    "comment": spot.comment,
-                    "tags": tags,
-                    "images": images,
-                }
-            )
+            spot_list.append(spot_to_dict(spot))
 
         # 100件で制限（現状意味はないが）
         if len(spot_list) >= 100:
@@ -107,6 +101,33 @@ def get_spots():
     return jsonify(spot_list)
 
 
+# スポットのベクタータイル　地図のパン・ズームではこちらを使う（id, category, titleのみ）
+# map.addSource('spots', { type: 'vector', tiles: [`${location.origin}/tiles/{z}/{x}/{y}.mvt`], maxzoom: 14 })
+@bp_view.route("/tiles/<int:z>/<int:x>/<int:y>.mvt", methods=["GET"])
+def get_tile(z, x, y):
+    if z > tiles.MAX_ZOOM or not (0 <= x < 2**z and 0 <= y < 2**z):
+        return jsonify({"error": "タイル座標が不正です"}), 404
+
+    path = tiles.cached_tile_path(z, x, y)
+    if path is not None:
+        return send_file(path, mimetype="application/vnd.mapbox-vector-tile", max_age=60)
+
+    response = Response(tiles.build_tile(z, x, y), mimetype="application/vnd.mapbox-vector-tile")
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+# スポット詳細（タイルのピンをクリックした時に取得）
+@bp_view.route("/spots/<int:spot_id>", methods=["GET"])
+def get_spot(spot_id):
+    spot = Spot.select().where(Spot.id == spot_id, Spot.deleted_at.is_null()).first()
+    if spot is None:
+        return jsonify({"error": "スポットが見つかりません"}), 404
+    return jsonify(spot_to_dict(spot))
+
+
 # スポット登録api 緯度経度、画像、タイトル、コメント、カテゴリー、タグを取得する
 # ここでjsonにしないのは画像をやり取りするから（jsonでは画像を扱えない)
 # formData.append('title', document.getElementById('spotTitle').value);
@@ -123,6 +144,8 @@ def get_spots():
 # if (imageFile) formData.append('image', imageFile);
 @bp_view.route("/spots/create", methods=["POST"])
 @login_required
+@rate_limit("create_spot")
+@limit_uploads
 def create_spot():
     # フォームデータ取得
     title = request.form.get("title", "").strip()
@@ -143,17 +166,20 @@ def create_spot():
             tags.append(tag_name)
 
     # spot作成　noneがないとタイムスタンプフィールドに値が入ってしまう　なぜ...
-    spot = Spot.create(
-        title=title,
-        comment=comment,
-        category=category,
-        lat=lat,
-        lng=lng,
-        start_date=None,
-        end_date=None,
-        deleted_at=None,
-        user=current_user.id,
-    )
+    # 密度グリッドへの足し込みも同じトランザクションで（density.rebuildに片方だけの状態を見せない）
+    with db.atomic():
+        spot = Spot.create(
+            title=title,
+            comment=comment,
+            category=category,
+            lat=lat,
+            lng=lng,
+            start_date=None,
+            end_date=None,
+            deleted_at=None,
+            user=current_user.id,
+        )
+        density.record_spot(spot)
 
     # 画像アップロード処理
     uploaded_file = request.files.get("image")
@@ -187,6 +213,11 @@ def create_spot():
         # SpotTagで関連付け
         SpotTag.create(spot=spot, tag=tag)
 
+    # このspotを含むタイルのキャッシュを消す
+    tiles.invalidate_points([(spot.lat, spot.lng)])
+    # 周辺spotのおすすめを再計算させる（このspot自身はバックグラウンドで初回計算される）
+    recommend.mark_stale_around([(spot.lat, spot.lng)])
+
     return jsonify(
         {
             "success": True,
@@ -238,6 +269,8 @@ def get_replies(spot_id):
 # if (file) fd.append('image', file);
 @bp_view.route("/spots/<int:spot_id>/replies", methods=["POST"])
 @login_required
+@rate_limit("create_reply")
+@limit_uploads
 def create_reply(spot_id):
     comment = request.form.get("comment", "").strip()
 
@@ -245,7 +278,12 @@ def create_reply(spot_id):
         return jsonify({"error": "コメントは必須です"}), 400
 
     # deleted_at=Noneに注意　返信が表示されない原因解明に時間かかった
-    reply = Reply.create(spot=spot_id, user=current_user.id, comment=comment, deleted_at=None)
+    # 削除されたspotへのリプライは数えない　spotの確認と足し込みもリプライの登録と同じトランザクションで
+    with db.atomic():
+        reply = Reply.create(spot=spot_id, user=current_user.id, comment=comment, deleted_at=None)
+        spot = Spot.get_or_none(Spot.id == spot_id, Spot.deleted_at.is_null())
+        if spot is not None:
+            density.record_reply(spot, reply)
 
     # 画像アップロード処理
     uploaded_file = request.files.get("image")
@@ -271,69 +309,74 @@ def create_reply(spot_id):
             path=unique_filename,
         )
 
+    # リプライ数が変わるのでspotを含むグループのバンドルを作り直させる
+    bundle.invalidate_groups_for_spots([spot_id])
+
+    if spot is not None:
+        # 混雑度が変わるので周辺のおすすめを再計算させる
+        recommend.mark_stale_around([(spot.lat, spot.lng)])
+
     return jsonify({"success": True})
 
 
 # グループの表示（今はURLからのみ）
+# QRコード経由で同じグループに大量アクセスが来るので、事前生成したバンドルをそのまま返す
+# バンドルがあればDBには触らない（spotやリプライが変わった時だけ再生成）
+def _latest_bundle_path(group_id, manifest=False):
+    # latestを読んでからファイルを開くまでに_cleanupやremove_groupで消されることがあるので、
+    # 見つからなければ1回だけ作り直して取り直す（グループが削除されていればNone）
+    version = bundle.latest_version(group_id)
+    path = bundle.bundle_path(group_id, version, manifest=manifest) if version else None
+    if path is None and version is not None:
+        version = bundle.build_group_bundle(group_id)
+        path = bundle.bundle_path(group_id, version, manifest=manifest) if version else None
+    return path
+
+
 @bp_view.route("/groups/<int:group_id>", methods=["GET"])
 def get_group(group_id):
-    try:
-        group = Group.select().where(Group.id == group_id, Group.deleted_at.is_null()).get()
-    except Group.DoesNotExist:
+    path = _latest_bundle_path(group_id)
+    if path is None:
         return jsonify({"error": "グループが見つかりません"}), 404
 
-    # グループ内のスポットを取得
-    # joinでgroupspotとspotを関連付け
-    group_spots = (
-        Spot.select()
-        .join(GroupSpot)
-        .where(GroupSpot.group == group_id, Spot.deleted_at.is_null())
-        .order_by(Spot.date.desc())
-    )
+    # 中身は変わりうるので短めのキャッシュ＋ETagで304を返せるように
+    return send_file(path, mimetype="application/json", max_age=60)
 
-    spots = []
-    for spot in group_spots:
-        # 中間テーブルからタグを取得
-        tags = [tag.name for tag in Tag.select().join(SpotTag).where(SpotTag.spot == spot)]
-        spots.append(
-            {
-                "id": spot.id,
-                "title": spot.title,
-                "lat": float(spot.lat),
-                "lng": float(spot.lng),
-                "category": spot.category,
-                "user_name": spot.user.name,
-                "user_icon": spot.user.icon,
-                "date": spot.date.strftime("%Y-%m-%d %H:%M"),
-                "comment": spot.comment,
-                "tags": tags,
-            }
-        )
 
-    # グループのタグ取得
-    group_tags = [tag.name for tag in Tag.select().join(GroupTag).where(GroupTag.group == group)]
+# 最新バンドルのURLへリダイレクト（versionを知らないクライアント向け）
+@bp_view.route("/groups/<int:group_id>/bundle", methods=["GET"])
+def get_group_bundle_latest(group_id):
+    version = bundle.latest_version(group_id)
+    if version is None:
+        return jsonify({"error": "グループが見つかりません"}), 404
+    return redirect(url_for("view.get_group_bundle", group_id=group_id, version=version))
 
-    # グループ画像取得（今は最初の1枚のみ）
-    group_images = [img.path for img in group.images]
 
-    return jsonify(
-        {
-            "group": {
-                "id": group.id,
-                "title": group.title,
-                "description": group.description,
-                "user_name": group.user.name,
-                "user_icon": group.user.icon,
-                "date": group.date.strftime("%Y-%m-%d %H:%M"),
-                "tags": group_tags,
-                "is_public": group.is_public,
-                "images": group_images,
-                "lat": group.lat,
-                "lon": group.lon,
-            },
-            "spots": spots,
-        }
-    )
+# version付きバンドル　内容のハッシュがversionなので中身は不変→長期キャッシュ
+@bp_view.route("/groups/<int:group_id>/bundle/<version>.json", methods=["GET"])
+def get_group_bundle(group_id, version):
+    path = bundle.bundle_path(group_id, version)
+    if path is None:
+        return jsonify({"error": "バンドルが見つかりません"}), 404
+    response = send_file(path, mimetype="application/json", max_age=31536000)
+    response.cache_control.immutable = True
+    return response
+
+
+# Service Worker用のマニフェスト（オフラインでも会場マップを開けるようにプリキャッシュ対象を返す）
+@bp_view.route("/groups/<int:group_id>/manifest.json", methods=["GET"])
+def get_group_manifest(group_id):
+    path = _latest_bundle_path(group_id, manifest=True)
+    if path is None:
+        return jsonify({"error": "グループが見つかりません"}), 404
+    return send_file(path, mimetype="application/json", max_age=60)
+
+
+# Service Worker　/static/以下から配信するとスコープが/static/に限られるのでルートから返す
+@bp_view.route("/sw.js", methods=["GET"])
+def service_worker():
+    path = os.path.join(current_app.static_folder, "js", "sw.js")
+    return send_file(path, mimetype="application/javascript", max_age=0)
 
 
 # グループへの返信表示
@@ -368,6 +411,8 @@ def get_group_replies(group_id):
 # if (file) fd.append('image', file);
 @bp_view.route("/groups/<int:group_id>/replies", methods=["POST"])
 @login_required
+@rate_limit("create_group_reply")
+@limit_uploads
 def create_group_reply(group_id):
     comment = request.form.get("comment", "").strip()
 
@@ -398,4 +443,6 @@ def create_group_reply(group_id):
             path=unique_filename,
         )
 
+    bundle.invalidate_group(group_id)
+
     return jsonify({"success": True})